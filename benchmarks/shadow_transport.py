@@ -0,0 +1,100 @@
+"""Compare the boto3 and SigV4 shadow transports
+
+    python benchmarks/shadow_transport.py [--calls 500] [--output FILE]
+
+Each transport runs in a fresh interpreter against a local
+FakeShadowHTTP, so import and client construction are included in the
+startup time and peak RSS. Results are printed as a table and
+optionally written as JSON.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TRANSPORTS = ['boto3', 'sigv4']
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def child(transport, endpoint, calls):
+    started = time.perf_counter()
+    from meter.shadow import BotoShadow, SigV4Shadow
+    shadow_type = {'boto3': BotoShadow, 'sigv4': SigV4Shadow}[transport]
+    shadow = shadow_type('bench', endpoint=endpoint)
+    shadow.get()
+    startup = time.perf_counter() - started
+
+    gets, updates = [], []
+    for i in range(calls):
+        t = time.perf_counter()
+        shadow.update({'meter': float(i % 100)})
+        updates.append(time.perf_counter() - t)
+        t = time.perf_counter()
+        shadow.get()
+        gets.append(time.perf_counter() - t)
+    shadow.close()
+
+    print(json.dumps({
+        'transport': transport,
+        'calls': calls,
+        'startup_ms': startup * 1000,
+        'get_p50_ms': percentile(gets, 50) * 1000,
+        'get_p99_ms': percentile(gets, 99) * 1000,
+        'update_p50_ms': percentile(updates, 50) * 1000,
+        'update_p99_ms': percentile(updates, 99) * 1000,
+        # kilobytes on Linux
+        'maxrss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }))
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--calls', type=int, default=500)
+    argparser.add_argument('--output', '-o', help='write results as JSON')
+    argparser.add_argument('--child', choices=TRANSPORTS,
+                           help=argparse.SUPPRESS)
+    argparser.add_argument('--endpoint', help=argparse.SUPPRESS)
+    options = argparser.parse_args()
+
+    if options.child:
+        return child(options.child, options.endpoint, options.calls)
+
+    sys.path.insert(0, ROOT)
+    from meter.fakes import FakeShadowHTTP
+    server = FakeShadowHTTP(('127.0.0.1', 0))
+    server.start()
+    endpoint = f'http://127.0.0.1:{server.server_address[1]}'
+
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    env.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    env.setdefault('AWS_ACCESS_KEY_ID', 'AKIDBENCHMARK')
+    env.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+    results = []
+    for transport in TRANSPORTS:
+        output = subprocess.run(
+            [sys.executable, __file__, '--child', transport,
+             '--endpoint', endpoint, '--calls', str(options.calls)],
+            env=env, capture_output=True, encoding='utf-8', check=True,
+        ).stdout
+        results.append(json.loads(output))
+    server.shutdown()
+
+    columns = [k for k in results[0] if k not in ('transport', 'calls')]
+    print(f'{"transport":10}' + ''.join(f'{c:>15}' for c in columns))
+    for r in results:
+        print(f'{r["transport"]:10}' + ''.join(f'{r[c]:15.2f}' for c in columns))
+    if options.output:
+        with open(options.output, 'w') as fp:
+            json.dump(results, fp, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+"""Run Meter.loop for each source against local stand-ins
+
+    python benchmarks/sources.py [--duration 10] [--period 0]
+        [--transport https] [--only OctoPrint ...] [--output FILE]
+        [--baseline FILE]
+
+Every upstream the sources talk to is served from meter.fakes on an
+ephemeral port: the shadow API (or MQTT broker for --transport mqtt),
+CloudWatch and Step Functions, OctoPrint, Open-Meteo and apcupsd. Each
+source runs in a fresh interpreter so peak RSS is its own.
+
+For every source this reports cycles per second, shadow writes per
+minute, per-stage latency percentiles (from Meter's own stage timers)
+and peak RSS. --output writes the results as JSON along with the git
+commit; --baseline compares against such a file from another commit.
+
+With the default --period 0 cycles run back to back and source
+next_update() hints are ignored, so the numbers measure the loop and
+the source rather than the scheduler; pass --hints to keep them.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import tempfile
+import threading
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# source command lines, formatted with the stand-in ports
+SCENARIOS = {
+    'Pomodoro': ['Pomodoro', '--work-time', '25'],
+    'CloudWatchAlarm': ['CloudWatchAlarm', 'bench-alarm'],
+    'CloudWatchMetrics': ['CloudWatchMetrics', '-A', 'bench-a', '-A',
+                          'bench-b', '-M', 'Fake,Requests,Service=bench'],
+    'SfnMapRun': ['SfnMapRun',
+                  'arn:aws:states:us-east-1:123456789012:mapRun:bench/run:1'],
+    'OctoPrint': ['OctoPrint', '--hostname', '127.0.0.1:{octoprint}',
+                  '--api-key', 'bench'],
+    'OutsideTemp': ['OutsideTemp', '--coords', '42.36,-71.06',
+                    '--api-url', 'http://127.0.0.1:{open-meteo}'],
+    'ApcUps': ['ApcUps', '--hostname', '127.0.0.1', '--port', '{apcupsd}'],
+}
+
+# about 5% resolution from 10us to a minute
+BUCKETS = tuple(1e-5 * 1.05 ** i for i in range(320))
+
+STAGES = ['cycle', 'sync', 'source', 'write']
+
+
+def child(options):
+    from meter import sources, stats
+    from meter.iot import Meter
+
+    args = json.loads(options.child)
+    source = sources.get_source(args[0])(args[1:], min_cycle=options.period)
+    if not options.hints:
+        source.next_update = lambda step: None
+    meter = Meter('bench', min_cycle=options.period,
+                  transport=options.transport,
+                  iot_endpoint=options.shadow_endpoint,
+                  mqtt_endpoint=options.shadow_endpoint)
+    meter.stats = stats.Stats(BUCKETS)
+    threading.Thread(target=meter.loop, args=(source,), daemon=True).start()
+
+    # discard connection setup and first reads
+    time.sleep(options.warmup)
+    meter.stats = measured = stats.Stats(BUCKETS)
+    time.sleep(options.duration)
+
+    with measured.lock:
+        timings = {stage: h for (stage, _), h in measured.timings.items()}
+        counters = dict(measured.counters)
+    cycles = timings['cycle'].count if 'cycle' in timings else 0
+    result = {
+        'source': args[0],
+        'transport': options.transport,
+        'duration_s': options.duration,
+        'cycles': cycles,
+        'cycles_per_s': cycles / options.duration,
+        'writes_per_min': counters.get(('writes', None, 'bench'), 0)
+                          * 60 / options.duration,
+        'skipped_per_min': counters.get(('writes_skipped', None, 'bench'), 0)
+                           * 60 / options.duration,
+        'errors': {stage: n for (name, stage, _), n in counters.items()
+                   if name == 'errors'},
+        'stages': {},
+        # kilobytes on Linux
+        'maxrss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+    for stage in STAGES:
+        h = timings.get(stage)
+        if h is None or not h.count:
+            continue
+        result['stages'][stage] = {
+            'count': h.count,
+            'mean_ms': h.sum / h.count * 1000,
+            'p50_ms': h.quantile(0.5) * 1000,
+            'p90_ms': h.quantile(0.9) * 1000,
+            'p99_ms': h.quantile(0.99) * 1000,
+            'max_ms': h.max * 1000,
+        }
+    print(json.dumps(result))
+    # the loop thread may be blocked in I/O, don't wait for it
+    sys.stdout.flush()
+    os._exit(0)
+
+
+def start_fakes(transport):
+    sys.path.insert(0, ROOT)
+    from meter import fakes
+    servers = {}
+    shadow_type = (fakes.FakeShadowBroker if transport == 'mqtt'
+                   else fakes.FakeShadowHTTP)
+    for name, server_type in [('shadow', shadow_type),
+                              ('aws', fakes.FakeAWS),
+                              ('octoprint', fakes.FakeOctoPrint),
+                              ('open-meteo', fakes.FakeOpenMeteo),
+                              ('apcupsd', fakes.FakeApcupsd)]:
+        servers[name] = server_type(('127.0.0.1', 0))
+        servers[name].start()
+    return servers
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+            capture_output=True, encoding='utf-8', check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_table(results, baseline=None):
+    baseline = {r['source']: r for r in (baseline or {}).get('results', [])}
+    print(f'{"source":20}{"cycles/s":>10}{"writes/min":>12}'
+          f'{"source p50":>12}{"source p99":>12}{"cycle p99":>11}'
+          f'{"rss MB":>8}{"vs base":>9}')
+    for r in results:
+        source = r['stages'].get('source', {})
+        cycle = r['stages'].get('cycle', {})
+        base = baseline.get(r['source'])
+        change = ''
+        if base and base['cycles_per_s']:
+            change = f'{r["cycles_per_s"] / base["cycles_per_s"] - 1:+.0%}'
+        print(f'{r["source"]:20}{r["cycles_per_s"]:10.1f}'
+              f'{r["writes_per_min"]:12.1f}'
+              f'{source.get("p50_ms", 0):10.2f}ms'
+              f'{source.get("p99_ms", 0):10.2f}ms'
+              f'{cycle.get("p99_ms", 0):9.2f}ms'
+              f'{r["maxrss_kb"] / 1024:8.1f}{change:>9}')
+        if r['errors']:
+            print(f'{"":20}errors: {r["errors"]}')
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--duration', type=float, default=10.0,
+                           help='seconds to measure each source for')
+    argparser.add_argument('--warmup', type=float, default=1.0)
+    argparser.add_argument('--period', type=float, default=0.0,
+                           help='meter --period, 0 runs cycles back to back')
+    argparser.add_argument('--hints', action='store_true',
+                           help='let sources hint their next update')
+    argparser.add_argument('--transport', default='https',
+                           choices=['https', 'sigv4', 'mqtt'])
+    argparser.add_argument('--only', nargs='+', choices=list(SCENARIOS),
+                           metavar='SOURCE', help='only run these sources')
+    argparser.add_argument('--output', '-o', help='write results as JSON')
+    argparser.add_argument('--baseline', help='JSON results to compare with')
+    argparser.add_argument('--child', help=argparse.SUPPRESS)
+    argparser.add_argument('--shadow-endpoint', help=argparse.SUPPRESS)
+    options = argparser.parse_args()
+
+    if options.child:
+        return child(options)
+
+    servers = start_fakes(options.transport)
+    ports = {name: s.server_address[1] for name, s in servers.items()}
+    scheme = 'mqtt' if options.transport == 'mqtt' else 'http'
+    shadow_endpoint = f'{scheme}://127.0.0.1:{ports["shadow"]}'
+
+    config_dir = tempfile.mkdtemp(prefix='meter-bench-')
+    # keep the fakes' data out of the user's config and caches
+    env = dict(os.environ, PYTHONPATH=ROOT,
+               METER_CONFIG=os.path.join(config_dir, 'meter.cfg'),
+               XDG_CACHE_HOME=os.path.join(config_dir, 'cache'),
+               AWS_ENDPOINT_URL=f'http://127.0.0.1:{ports["aws"]}')
+    env.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    env.setdefault('AWS_ACCESS_KEY_ID', 'AKIDBENCHMARK')
+    env.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+
+    results = []
+    for name in options.only or SCENARIOS:
+        args = [a.format(**ports) if '{' in a else a
+                for a in SCENARIOS[name]]
+        command = [
+            sys.executable, __file__, '--child', json.dumps(args),
+            '--shadow-endpoint', shadow_endpoint,
+            '--transport', options.transport,
+            '--duration', str(options.duration),
+            '--warmup', str(options.warmup),
+            '--period', str(options.period),
+        ] + (['--hints'] if options.hints else [])
+        process = subprocess.run(command, env=env, capture_output=True,
+                                 encoding='utf-8')
+        if process.returncode:
+            print(f'{name} failed:\n{process.stderr}', file=sys.stderr)
+            continue
+        results.append(json.loads(process.stdout.strip().splitlines()[-1]))
+
+    for server in servers.values():
+        server.shutdown()
+
+    baseline = None
+    if options.baseline:
+        with open(options.baseline) as fp:
+            baseline = json.load(fp)
+    print_table(results, baseline)
+    if options.output:
+        with open(options.output, 'w') as fp:
+            json.dump({
+                'commit': git_commit(),
+                'python': platform.python_version(),
+                'options': {k: getattr(options, k) for k in (
+                    'duration', 'warmup', 'period', 'hints', 'transport')},
+                'results': results,
+            }, fp, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from meter.stats import STATS
+
+logger = logging.getLogger(__name__)
+
+
+def assume(arn, duration=12*60*60):
+    import boto3
+    sts = boto3.client('sts')
+    response = sts.assume_role(
+        RoleArn=arn,
+        RoleSessionName='meter',
+        DurationSeconds=duration
+    )
+    credentials = response['Credentials']
+    credentials['Expiration'] = credentials['Expiration'].astimezone()
+    logger.info(f'Refreshed credentials,'
+                f' expiration {credentials["Expiration"]}')
+    return credentials
+
+
+def remaining(credentials):
+    return credentials['Expiration'] - datetime.now().astimezone()
+
+
+class ClientManager:
+    """boto3 clients shared across the process, per service and region
+
+    Without a role the ambient credentials are used. With a role, it
+    is assumed up front and then re-assumed on a background thread
+    `margin` before the credentials expire. Replacement clients are
+    built on that thread too, so callers of client() never wait on STS
+    or on client construction.
+
+    """
+    def __init__(self, role_arn=None, pool_size=10,
+                 margin=timedelta(seconds=3600)):
+        self.role_arn = role_arn
+        self.pool_size = pool_size
+        self.margin = margin
+        self.lock = threading.Lock()
+        self.start_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.credentials = None
+        self.session = None
+        self.clients = {}
+        self.thread = None
+
+    def start(self):
+        with self.start_lock:
+            if self.session is not None:
+                return
+            if self.role_arn:
+                self.refresh()
+                self.thread = threading.Thread(
+                    target=self.run, name='meter-credentials', daemon=True
+                )
+                self.thread.start()
+            else:
+                import boto3
+                self.session = boto3.Session()
+
+    def new_client(self, session, service, region, endpoint_url=None):
+        from botocore.config import Config
+        return session.client(
+            service, region_name=region, endpoint_url=endpoint_url,
+            config=Config(max_pool_connections=self.pool_size)
+        )
+
+    def refresh(self):
+        import boto3
+        with STATS.timer('credentials'):
+            credentials = assume(self.role_arn)
+        session = boto3.Session(
+            aws_access_key_id=credentials['AccessKeyId'],
+            aws_secret_access_key=credentials['SecretAccessKey'],
+            aws_session_token=credentials['SessionToken']
+        )
+        with self.lock:
+            keys = list(self.clients)
+        # the new session is private until the swap below, so its
+        # clients can be built without holding the lock
+        clients = {key: self.new_client(session, *key) for key in keys}
+        with self.lock:
+            self.credentials = credentials
+            self.session = session
+            self.clients = clients
+
+    def run(self):
+        while True:
+            delay = (remaining(self.credentials) - self.margin).total_seconds()
+            if self.stopped.wait(max(delay, 0)):
+                return
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception('credential refresh failed, retrying')
+                if self.stopped.wait(60):
+                    return
+
+    def stop(self):
+        self.stopped.set()
+
+    def client(self, service, region=None, endpoint_url=None):
+        self.start()
+        key = (service, region, endpoint_url)
+        with self.lock:
+            if key not in self.clients:
+                # botocore sessions are not safe for concurrent client
+                # construction, so build under the lock
+                self.clients[key] = self.new_client(self.session, *key)
+            return self.clients[key]
+
+    def boto3_session(self):
+        self.start()
+        return self.session
+
+
+MANAGERS = {}
+MANAGERS_LOCK = threading.Lock()
+
+
+def manager(role_arn=None):
+    """Return the shared ClientManager for role_arn (None: ambient)"""
+    with MANAGERS_LOCK:
+        if role_arn not in MANAGERS:
+            MANAGERS[role_arn] = ClientManager(role_arn)
+        return MANAGERS[role_arn]
+
+
+def client(service, region=None, role_arn=None):
+    """Return a shared boto3 client, created on first use"""
+    return manager(role_arn).client(service, region)
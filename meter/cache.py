@@ -0,0 +1,80 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+
+def cache_dir(name):
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, 'meter', name)
+
+
+class DiskCache:
+    """JSON documents on disk, shared between processes
+
+    Each key is one file, replaced atomically, so concurrent readers
+    never see a partial write. Entries older than ttl are ignored, and
+    the oldest files are removed once there are more than max_entries.
+
+    """
+    def __init__(self, directory, ttl=3600.0, max_entries=32):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+    def path(self, key):
+        digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+        return os.path.join(self.directory, f'{digest}.json')
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                return None
+            with open(path) as fp:
+                entry = json.load(fp)
+        except (OSError, ValueError):
+            return None
+        # guard against a digest collision
+        return entry['value'] if entry.get('key') == key else None
+
+    def set(self, key, value):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'w') as fp:
+                json.dump({'key': key, 'value': value}, fp)
+            os.replace(tmp, self.path(key))
+            self.prune()
+        except OSError:
+            logger.warning(f'could not write cache in {self.directory}',
+                           exc_info=True)
+
+    def prune(self):
+        entries = []
+        now = time.time()
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError:
+                continue
+            # stray temp files from a crashed writer, and expired entries
+            if now - mtime > self.ttl or (name.endswith('.tmp')
+                                          and now - mtime > 60):
+                self.remove(path)
+            elif name.endswith('.json'):
+                entries.append((mtime, path))
+        entries.sort()
+        for _, path in entries[:max(0, len(entries) - self.max_entries)]:
+            self.remove(path)
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
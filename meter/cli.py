@@ -1,29 +1,29 @@
 import os
 import sys
+import time
+import asyncio
 import logging
 import argparse
 
 os.environ.setdefault('METER_CONFIG', os.path.expanduser('~/.meter.cfg'))
 
-from meter import sources, config, iot
+from meter import sources, config, iot, utils, stats
 
 
 def print_sources():
-    for k, v in vars(sources).items():
-        try:
-            if not issubclass(v, sources.base.BaseSource):
-                continue
-            if v.description:
-                print(k, '--', v.description())
-            else:
-                print(k)
-        except TypeError:
-            pass
+    for k in sources.SOURCES:
+        v = sources.get_source(k)
+        if v.description():
+            print(k, '--', v.description())
+        else:
+            print(k)
 
 
 def main():
-    argparser = config.DefaultArgumentParser()
-    argparser.add_argument('source', config_save=False)
+    argparser = config.DefaultArgumentParser(autosave=False)
+    argparser.add_argument('source', nargs='?', config_save=False,
+                           help=("source name, or 'fleet' to run every Thing"
+                                 " listed in the [FLEET] config section"))
     argparser.add_argument('--thing-name', default='pico_w_meter')
     argparser.add_argument('--verbose', '-v', action='count', default=0,
                            config_save=False)
@@ -41,8 +41,67 @@ def main():
                            help="log unit temperature")
     argparser.add_argument('--period', '-s', type=int, metavar="SECONDS",
                            default=4, help="minimum time between polling cycles")
+    argparser.add_argument('--fast-period', type=float, metavar="SECONDS",
+                           help="time between cycles while the value is changing")
+    argparser.add_argument('--idle-period', type=float, metavar="SECONDS",
+                           help=("time between cycles once the value has been"
+                                 " flat for --idle-after seconds"))
+    argparser.add_argument('--idle-after', type=float, metavar="SECONDS",
+                           default=300.0)
+    argparser.add_argument('--transport', choices=['https', 'sigv4', 'mqtt'],
+                           default='https',
+                           help=("shadow transport; 'sigv4' signs requests"
+                                 " itself instead of using a boto3 client,"
+                                 " 'mqtt' keeps one connection open and"
+                                 " receives reported state as it is pushed"))
+    argparser.add_argument('--iot-endpoint', metavar="URL", config_save=False,
+                           help="IoT data plane endpoint for https/sigv4")
+    argparser.add_argument('--mqtt-endpoint', metavar="URL", config_save=False,
+                           help=("MQTT endpoint, e.g. mqtt://localhost:1883"
+                                 " for a local broker; defaults to the"
+                                 " account's AWS IoT endpoint over wss://"))
+    argparser.add_argument('--write-only', '-w', action='store',
+                           type=config.to_bool, default=False,
+                           help=("keep a local mirror of the shadow and only"
+                                 " read it at startup and every --resync"
+                                 " seconds"))
+    argparser.add_argument('--resync', type=float, metavar="SECONDS",
+                           default=300.0,
+                           help="in write-only mode, re-read the shadow this often")
+    argparser.add_argument('--deadband', '-d', default='0', metavar="VALUE",
+                           help=("skip shadow writes for changes smaller than"
+                                 " VALUE, either one number or per channel,"
+                                 " e.g. meter=0.5,red=2"))
+    argparser.add_argument('--pwm-resolution', type=int, metavar="STEPS",
+                           default=65535,
+                           help=("round channel values to the device's PWM"
+                                 " resolution before comparing"))
+    argparser.add_argument('--engine', choices=['sync', 'asyncio'],
+                           default='sync',
+                           help=("'asyncio' fetches the source and reads the"
+                                 " shadow concurrently"))
+    argparser.add_argument('--workers', type=int,
+                           help=("thread pool size for the asyncio engine"
+                                 " (default 4) and fleet mode (default one"
+                                 " per meter, at least 16)"))
+    argparser.add_argument('--stats', action='store_true', config_save=False,
+                           help="print per-stage timings and counters on exit")
+    argparser.add_argument('--metrics-port', type=int, metavar="PORT",
+                           help=("serve timings and counters in the Prometheus"
+                                 " text format on 127.0.0.1:PORT/metrics"))
+    argparser.add_argument('--record', metavar="FILE", config_save=False,
+                           help=("log every reported state and source update"
+                                 " to FILE, see python -m meter.record"))
+    argparser.add_argument('--replay', metavar="FILE", config_save=False,
+                           help=("run the cycle logic over a --record log"
+                                 " offline, as fast as possible"))
     
     options, remaining = argparser.parse_known_args()
+    if options.source is None and not options.replay:
+        argparser.error('the source argument is required')
+    # settings tried out on a replay shouldn't change live runs
+    if not options.replay:
+        argparser.save(options)
 
     logging.basicConfig(
         format=(
@@ -56,7 +115,6 @@ def main():
             2: logging.DEBUG,
         }[options.verbose]
     )
-    logger = logging.getLogger(__name__)
 
     # handle setup assume role
     if options.setup_iot_assume_role_from:
@@ -64,8 +122,69 @@ def main():
         print('Done!')
         sys.exit(0)
     
+    meter_kwargs = dict(
+        show_temp=options.show_temperature,
+        write_only=options.write_only,
+        resync=options.resync,
+        deadband=utils.parse_channels(options.deadband),
+        pwm_resolution=options.pwm_resolution,
+        fast_cycle=options.fast_period,
+        idle_cycle=options.idle_period,
+        idle_after=options.idle_after,
+    )
+
+    if options.metrics_port:
+        stats.MetricsServer(('127.0.0.1', options.metrics_port)).start()
     try:
-        source_type = getattr(sources, options.source)
+        run(options, remaining, meter_kwargs)
+    finally:
+        if options.stats:
+            print(stats.STATS.summary())
+
+
+def replay(options, meter_kwargs):
+    from meter import record
+    meter = iot.Meter(options.thing_name, shadow=record.ReplayShadow(),
+                      **meter_kwargs)
+    started = time.perf_counter()
+    cycles = record.replay(meter, options.replay)
+    elapsed = time.perf_counter() - started
+    counters = meter.stats.counters
+    print(f'{cycles} cycles in {elapsed:.2f}s'
+          f' ({cycles / elapsed if elapsed else 0:.0f}/s),'
+          f' {counters.get(("writes", None, meter.thing), 0)} writes,'
+          f' {counters.get(("writes_skipped", None, meter.thing), 0)} skipped')
+
+
+def run(options, remaining, meter_kwargs):
+    logger = logging.getLogger(__name__)
+    if options.replay:
+        return replay(options, meter_kwargs)
+    if options.source == 'fleet':
+        from meter.fleet import Fleet, read_fleet
+        things = read_fleet()
+        if not things:
+            print(f'no meters configured in [FLEET] in {os.environ["METER_CONFIG"]}')
+            sys.exit(1)
+        fleet = Fleet(
+            things,
+            min_cycle=options.period,
+            assume_role=options.iot_assume_role_to,
+            transport=options.transport,
+            mqtt_endpoint=options.mqtt_endpoint,
+            iot_endpoint=options.iot_endpoint,
+            max_workers=options.workers,
+            **meter_kwargs
+        )
+        try:
+            fleet.run()
+        except KeyboardInterrupt:
+            fleet.clear()
+            logger.warning("Clean exit.")
+        return
+
+    try:
+        source_type = sources.get_source(options.source)
     except AttributeError:
         print(f'source {options.source} not found!')
         print('available sources:')
@@ -74,17 +193,32 @@ def main():
         sys.exit(1)
 
     s = source_type(remaining, min_cycle=options.period)
+    recorder = None
+    if options.record:
+        from meter import record
+        recorder = record.Recorder(options.record, source=options.source,
+                                   uses_reported=s.USES_REPORTED)
     meter = iot.Meter(
         options.thing_name,
         min_cycle=options.period,
         assume_role=options.iot_assume_role_to,
-        show_temp=options.show_temperature,
+        transport=options.transport,
+        mqtt_endpoint=options.mqtt_endpoint,
+        iot_endpoint=options.iot_endpoint,
+        recorder=recorder,
+        **meter_kwargs
     )
     try:
-        meter.loop(s)
+        if options.engine == 'asyncio':
+            asyncio.run(meter.aloop(s, max_workers=options.workers or 4))
+        else:
+            meter.loop(s)
     except KeyboardInterrupt:
         meter.clear()
         logger.warning("Clean exit.")
+    finally:
+        if recorder:
+            recorder.close()
 
         
 if __name__ == '__main__':
@@ -3,6 +3,7 @@ import argparse
 import configparser
 
 CONFIG = configparser.ConfigParser()
+CONFIG.optionxform = str  # keep case, e.g. for Thing names in [FLEET]
 CONFIG.read(os.environ['METER_CONFIG'])
 
 def to_bool(s):
@@ -22,6 +23,10 @@ class DefaultArgumentParser(argparse.ArgumentParser):
             del(kwargs['source'])
         else:
             self.source = 'MAIN'
+        # False: neither take defaults from nor save to the config file
+        self.use_config = kwargs.pop('use_config', True)
+        # False: only save when save() is called
+        self.autosave = kwargs.pop('autosave', True)
 
         self.config_save = {}
             
@@ -35,7 +40,8 @@ class DefaultArgumentParser(argparse.ArgumentParser):
         if dest:
             dest = dest.lstrip('-').replace('-', '_')
             self.config_save[dest] = do_save
-            if self.source in CONFIG and dest in CONFIG[self.source]:
+            if self.use_config and self.source in CONFIG \
+               and dest in CONFIG[self.source]:
                 default_type = str
                 if kwargs.get('action') in ('store_true', 'store_false'):
                     default_type = to_bool
@@ -47,6 +53,12 @@ class DefaultArgumentParser(argparse.ArgumentParser):
         return super().add_argument(*args, **kwargs)
 
     def _update_config(self, options):
+        if self.autosave:
+            self.save(options)
+
+    def save(self, options):
+        if not self.use_config:
+            return
         if self.source not in CONFIG:
             CONFIG[self.source] = {}
         for k, v in vars(options).items():
@@ -72,7 +84,7 @@ class DefaultArgumentParser(argparse.ArgumentParser):
             and self._namespace.source is not None):
             try:
                 from meter import sources
-                source_type = getattr(sources, self._namespace.source)
+                source_type = sources.get_source(self._namespace.source)
             except AttributeError:
                 print(f'NOTE: source {self._namespace.source} not found')
                 return
@@ -0,0 +1,643 @@
+"""Local stand-ins for the cloud services used by meter
+
+    python -m meter.fakes shadow --port 1883
+
+runs a minimal MQTT 3.1.1 broker that also implements the AWS IoT
+device shadow topics, so `meter --transport mqtt --mqtt-endpoint
+mqtt://localhost:1883` can run without AWS.
+
+    python -m meter.fakes shadow-http --port 8080
+
+serves the IoT data plane shadow API over plain HTTP, for
+`--transport https` or `sigv4` with `--iot-endpoint
+http://localhost:8080`. Request signatures are not checked.
+
+The other services stand in for the upstream APIs the sources poll,
+with values that move over time:
+
+    python -m meter.fakes aws         # CloudWatch and Step Functions,
+                                      # use AWS_ENDPOINT_URL=http://...
+    python -m meter.fakes octoprint   # --hostname localhost:5000
+    python -m meter.fakes open-meteo  # --api-url http://localhost:8081
+    python -m meter.fakes apcupsd     # --hostname localhost
+"""
+import zlib
+import json
+import base64
+import hashlib
+import math
+import time
+import struct
+import logging
+import argparse
+import threading
+import socketserver
+from urllib.parse import parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from meter.utils import merge
+
+logger = logging.getLogger(__name__)
+
+
+def topic_matches(topic_filter, topic):
+    f_parts = topic_filter.split('/')
+    t_parts = topic.split('/')
+    for i, f in enumerate(f_parts):
+        if f == '#':
+            return True
+        if i >= len(t_parts) or (f != '+' and f != t_parts[i]):
+            return False
+    return len(f_parts) == len(t_parts)
+
+
+def encode_length(n):
+    out = bytearray()
+    while True:
+        b, n = n % 128, n // 128
+        out.append(b | 0x80 if n else b)
+        if not n:
+            return bytes(out)
+
+
+def encode_str(s):
+    s = s.encode() if isinstance(s, str) else s
+    return struct.pack('!H', len(s)) + s
+
+
+class BackgroundServer:
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def handle_error(self, request, client_address):
+        # clients going away mid-request is routine here
+        logger.debug(f'error serving {client_address}', exc_info=True)
+
+
+def cycle(period):
+    """Fraction of the way through the current period of the clock"""
+    return (time.time() % period) / period
+
+
+class ShadowStore:
+    """In-memory shadow documents with version and metadata"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.things = {}
+
+    def get(self, thing):
+        with self.lock:
+            doc = self.things.setdefault(
+                thing, {'state': {}, 'metadata': {}, 'version': 0}
+            )
+            return json.loads(json.dumps(doc))
+
+    def update(self, thing, state):
+        now = int(time.time())
+        with self.lock:
+            doc = self.things.setdefault(
+                thing, {'state': {}, 'metadata': {}, 'version': 0}
+            )
+            previous = json.loads(json.dumps(doc))
+            for section, values in state.items():
+                merge(doc['state'].setdefault(section, {}), values)
+                merge(doc['metadata'].setdefault(section, {}),
+                      {k: {'timestamp': now} for k in values})
+            doc['version'] += 1
+            current = json.loads(json.dumps(doc))
+        accepted = {
+            'state': state,
+            'metadata': {
+                section: {k: {'timestamp': now} for k in values}
+                for section, values in state.items()
+            },
+            'version': current['version'],
+            'timestamp': now,
+        }
+        documents = {
+            'previous': previous,
+            'current': current,
+            'timestamp': now,
+        }
+        return accepted, documents
+
+
+class MqttHandler(socketserver.BaseRequestHandler):
+    def setup(self):
+        self.wlock = threading.Lock()
+        self.subscriptions = set()
+        self.server.clients.add(self)
+
+    def finish(self):
+        self.server.clients.discard(self)
+
+    def recv_exact(self, n):
+        data = b''
+        while len(data) < n:
+            chunk = self.request.recv(n - len(data))
+            if not chunk:
+                raise EOFError
+            data += chunk
+        return data
+
+    def send_packet(self, header, body=b''):
+        with self.wlock:
+            self.request.sendall(bytes([header]) + encode_length(len(body))
+                                 + body)
+
+    def publish(self, topic, payload):
+        self.send_packet(0x30, encode_str(topic) + payload)
+
+    def handle(self):
+        try:
+            while True:
+                header = self.recv_exact(1)[0]
+                length, shift = 0, 0
+                while True:
+                    b = self.recv_exact(1)[0]
+                    length += (b & 0x7f) << shift
+                    shift += 7
+                    if not b & 0x80:
+                        break
+                body = self.recv_exact(length) if length else b''
+                if not self.dispatch(header, body):
+                    return
+        except (EOFError, ConnectionError, OSError):
+            return
+
+    def dispatch(self, header, body):
+        kind = header >> 4
+        if kind == 1:  # CONNECT
+            self.send_packet(0x20, b'\x00\x00')
+        elif kind == 3:  # PUBLISH
+            qos = (header >> 1) & 3
+            n = struct.unpack('!H', body[:2])[0]
+            topic = body[2:2 + n].decode()
+            pos = 2 + n
+            if qos:
+                self.send_packet(0x40, body[pos:pos + 2])
+                pos += 2
+            self.server.route(topic, body[pos:])
+        elif kind == 8:  # SUBSCRIBE
+            packet_id, pos, granted = body[:2], 2, b''
+            while pos < len(body):
+                n = struct.unpack('!H', body[pos:pos + 2])[0]
+                self.subscriptions.add(body[pos + 2:pos + 2 + n].decode())
+                pos += 3 + n
+                granted += b'\x00'
+            self.send_packet(0x90, packet_id + granted)
+        elif kind == 12:  # PINGREQ
+            self.send_packet(0xd0)
+        elif kind == 14:  # DISCONNECT
+            return False
+        return True
+
+
+class FakeShadowBroker(BackgroundServer, socketserver.ThreadingTCPServer):
+    """Minimal MQTT broker with AWS IoT shadow topic semantics
+
+    Only QoS 0 is delivered to subscribers (QoS 1 publishes are
+    acknowledged), which is enough for the shadow request/response
+    topics.
+
+    """
+    def __init__(self, address=('127.0.0.1', 1883)):
+        self.clients = set()
+        self.shadows = ShadowStore()
+        super().__init__(address, MqttHandler)
+
+    def deliver(self, topic, payload):
+        for client in list(self.clients):
+            if any(topic_matches(f, topic) for f in client.subscriptions):
+                try:
+                    client.publish(topic, payload)
+                except OSError:
+                    pass
+
+    def route(self, topic, payload):
+        self.deliver(topic, payload)
+        parts = topic.split('/')
+        if parts[:2] != ['$aws', 'things'] or parts[3:4] != ['shadow']:
+            return
+        thing, op = parts[2], '/'.join(parts[4:])
+        prefix = f'$aws/things/{thing}/shadow'
+        if op == 'get':
+            self.deliver(f'{prefix}/get/accepted',
+                         json.dumps(self.shadows.get(thing)).encode())
+        elif op == 'update':
+            request = json.loads(payload)
+            accepted, documents = self.shadows.update(thing, request['state'])
+            self.deliver(f'{prefix}/update/accepted',
+                         json.dumps(accepted).encode())
+            self.deliver(f'{prefix}/update/documents',
+                         json.dumps(documents).encode())
+
+
+class JSONHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, avoid delayed-ACK stalls
+    disable_nagle_algorithm = True
+    content_type = 'application/json'
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def reply(self, status, document):
+        body = json.dumps(document).encode()
+        etag = f'"{zlib.crc32(body):08x}"'
+        if self.command == 'GET' and \
+           self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(status)
+        self.send_header('Content-Type', self.content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if self.command == 'GET':
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length) or b'{}')
+
+
+class ShadowHTTPHandler(JSONHandler):
+    def thing(self):
+        parts = self.path.split('?')[0].strip('/').split('/')
+        if len(parts) == 3 and parts[0] == 'things' and parts[2] == 'shadow':
+            return parts[1]
+        return None
+
+    def do_GET(self):
+        thing = self.thing()
+        if thing is None:
+            return self.reply(404, {'message': 'Not Found'})
+        self.reply(200, self.server.shadows.get(thing))
+
+    def do_POST(self):
+        thing = self.thing()
+        request = self.read_json()
+        if thing is None:
+            return self.reply(404, {'message': 'Not Found'})
+        accepted, _ = self.server.shadows.update(thing, request['state'])
+        self.reply(200, accepted)
+
+
+class FakeShadowHTTP(BackgroundServer, ThreadingHTTPServer):
+    """IoT data plane shadow API (GET/POST /things/NAME/shadow)"""
+
+    def __init__(self, address=('127.0.0.1', 8080), shadows=None):
+        self.shadows = shadows or ShadowStore()
+        super().__init__(address, ShadowHTTPHandler)
+
+
+class AWSJSONHandler(JSONHandler):
+    content_type = 'application/x-amz-json-1.0'
+
+    def do_POST(self):
+        target = self.headers.get('X-Amz-Target', '')
+        request = self.read_json()
+        operation = getattr(self.server, target.rsplit('.', 1)[-1], None)
+        if operation is None:
+            return self.reply(400, {
+                '__type': 'UnknownOperationException',
+                'message': f'{target} is not implemented',
+            })
+        self.reply(200, operation(request))
+
+
+class FakeAWS(BackgroundServer, ThreadingHTTPServer):
+    """CloudWatch and Step Functions over the AWS JSON protocol
+
+    Point boto3 at it with AWS_ENDPOINT_URL. Every alarm exists, is
+    backed by one metric and is in ALARM for the top fifth of a ten
+    minute sine wave; every Map Run takes ten minutes, and one item in
+    fifty fails.
+
+    """
+    def __init__(self, address=('127.0.0.1', 4566)):
+        super().__init__(address, AWSJSONHandler)
+
+    def metric_value(self, t):
+        return 50.0 + 50.0 * math.sin(2 * math.pi * (t % 600) / 600)
+
+    def DescribeAlarms(self, request):
+        now = time.time()
+        state = 'ALARM' if self.metric_value(now) > 80 else 'OK'
+        alarms = [{
+            'AlarmName': name,
+            'StateValue': state,
+            'AlarmConfigurationUpdatedTimestamp': 0,
+            'Metrics': [{
+                'Id': 'm1',
+                'MetricStat': {
+                    'Metric': {'Namespace': 'Fake', 'MetricName': name,
+                               'Dimensions': []},
+                    'Period': 60,
+                    'Stat': 'Average',
+                },
+                'ReturnData': True,
+            }],
+        } for name in request.get('AlarmNames', ['fake'])]
+        return {'MetricAlarms': alarms, 'CompositeAlarms': []}
+
+    def GetMetricData(self, request):
+        start, end = request['StartTime'], request['EndTime']
+        timestamps = []
+        t = end - end % 60
+        while t >= start:
+            timestamps.append(t)
+            t -= 60
+        if request.get('ScanBy') == 'TimestampAscending':
+            timestamps.reverse()
+        return {'MetricDataResults': [{
+            'Id': q['Id'],
+            'Label': q['Id'],
+            'Timestamps': timestamps,
+            'Values': [self.metric_value(t) for t in timestamps],
+            'StatusCode': 'Complete',
+        } for q in request['MetricDataQueries'] if q.get('ReturnData', True)]}
+
+    def DescribeMapRun(self, request):
+        total = 1000
+        done = int(total * cycle(600))
+        failed = done // 50
+        return {
+            'mapRunArn': request['mapRunArn'],
+            'status': 'RUNNING',
+            'itemCounts': {
+                'pending': 0, 'running': total - done,
+                'succeeded': done - failed, 'failed': failed,
+                'timedOut': 0, 'aborted': 0, 'total': total,
+                'resultsWritten': done,
+            },
+        }
+
+
+WS_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+
+def ws_frame(opcode, payload=b''):
+    """Encode an unmasked (server to client) websocket frame"""
+    if len(payload) < 126:
+        header = struct.pack('!BB', 0x80 | opcode, len(payload))
+    elif len(payload) < 65536:
+        header = struct.pack('!BBH', 0x80 | opcode, 126, len(payload))
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 127, len(payload))
+    return header + payload
+
+
+def ws_read(rfile):
+    """Read one (masked, client to server) frame, return (opcode, payload)"""
+    b0, b1 = rfile.read(2)
+    length = b1 & 0x7f
+    if length == 126:
+        length = struct.unpack('!H', rfile.read(2))[0]
+    elif length == 127:
+        length = struct.unpack('!Q', rfile.read(8))[0]
+    mask = rfile.read(4) if b1 & 0x80 else b'\x00' * 4
+    payload = bytes(b ^ mask[i % 4] for i, b in enumerate(rfile.read(length)))
+    return b0 & 0x0f, payload
+
+
+def octoprint_job():
+    # a 30 minute print, then 5 minutes idle
+    fraction = cycle(35 * 60) * 35 / 30
+    if fraction >= 1:
+        return {
+            'state': 'Operational',
+            'job': {'file': {'name': None}},
+            'progress': {'completion': None, 'printTime': None,
+                         'printTimeLeft': None},
+        }
+    return {
+        'state': 'Printing',
+        'job': {'file': {'name': 'fake.gcode'}},
+        'progress': {
+            'completion': fraction * 100.0,
+            'printTime': int(fraction * 1800),
+            'printTimeLeft': int((1 - fraction) * 1800),
+        },
+    }
+
+
+class OctoPrintHandler(JSONHandler):
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path == '/sockjs/websocket':
+            return self.push()
+        if path != '/api/job':
+            return self.reply(404, {'error': 'Not Found'})
+        self.reply(200, octoprint_job())
+
+    def do_POST(self):
+        self.read_json()
+        if self.path.split('?')[0] != '/api/login':
+            return self.reply(404, {'error': 'Not Found'})
+        self.reply(200, {'name': 'fake', 'session': 'fake-session',
+                         'active': True})
+
+    def push(self):
+        """Push a `current` message every 500ms times the throttle"""
+        key = self.headers.get('Sec-WebSocket-Key', '')
+        accept = base64.b64encode(
+            hashlib.sha1((key + WS_GUID).encode()).digest()
+        ).decode()
+        self.send_response(101)
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', accept)
+        self.end_headers()
+        self.close_connection = True
+
+        wlock = threading.Lock()
+        closed = threading.Event()
+        session = {'throttle': 1, 'authed': False}
+
+        def send(opcode, payload=b''):
+            with wlock:
+                self.wfile.write(ws_frame(opcode, payload))
+                self.wfile.flush()
+
+        def read():
+            try:
+                while True:
+                    opcode, payload = ws_read(self.rfile)
+                    if opcode == 8:
+                        send(8)
+                        break
+                    if opcode == 9:
+                        send(10, payload)
+                    elif opcode == 1:
+                        message = json.loads(payload)
+                        session['authed'] |= 'auth' in message
+                        session['throttle'] = message.get(
+                            'throttle', session['throttle'])
+            except (ValueError, ConnectionError, OSError):
+                pass
+            closed.set()
+
+        threading.Thread(target=read, daemon=True).start()
+        try:
+            send(1, json.dumps({'connected': {'version': 'fake'}}).encode())
+            while not closed.wait(0.5 * session['throttle']):
+                if not session['authed']:
+                    continue
+                job = octoprint_job()
+                send(1, json.dumps({'current': dict(
+                    job, state={'text': job['state'], 'flags': {}},
+                    currentZ=None, offsets={}, temps=[], logs=[],
+                    messages=[], busyFiles=[],
+                )}).encode())
+        except (ConnectionError, OSError):
+            return
+
+
+class FakeOctoPrint(BackgroundServer, ThreadingHTTPServer):
+    """OctoPrint job and push APIs, API keys are not checked
+
+    GET /api/job, POST /api/login and the /sockjs/websocket push
+    endpoint, which sends `current` messages once a client has sent
+    `auth`.
+
+    """
+    def __init__(self, address=('127.0.0.1', 5000)):
+        super().__init__(address, OctoPrintHandler)
+
+
+class OpenMeteoHandler(JSONHandler):
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        if path != '/v1/forecast':
+            return self.reply(404, {'error': True, 'reason': 'Not Found'})
+        query = parse_qs(query)
+        now = time.time()
+        hour = int(now - now % 3600)
+
+        def temperature(t):
+            # daily swing between 5 and 15 C
+            return round(10.0 - 5.0 * math.cos(2 * math.pi * (t % 86400)
+                                               / 86400), 1)
+
+        def iso(t):
+            if query.get('timeformat') == ['unixtime']:
+                return t
+            return time.strftime('%Y-%m-%dT%H:%M', time.gmtime(t))
+
+        hours = range(hour - 86400, hour + 7 * 86400, 3600)
+        self.reply(200, {
+            'utc_offset_seconds': 0,
+            'current_weather': {'time': iso(hour),
+                                'temperature': temperature(hour)},
+            'hourly': {
+                'time': [iso(t) for t in hours],
+                'temperature_2m': [temperature(t) for t in hours],
+            },
+        })
+
+
+class FakeOpenMeteo(BackgroundServer, ThreadingHTTPServer):
+    """Open-Meteo forecast API (GET /v1/forecast), in UTC"""
+
+    def __init__(self, address=('127.0.0.1', 8081)):
+        super().__init__(address, OpenMeteoHandler)
+
+
+class NISHandler(socketserver.BaseRequestHandler):
+    def recv_exact(self, n):
+        data = b''
+        while len(data) < n:
+            chunk = self.request.recv(n - len(data))
+            if not chunk:
+                raise EOFError
+            data += chunk
+        return data
+
+    def handle(self):
+        try:
+            while True:
+                length = struct.unpack('!H', self.recv_exact(2))[0]
+                command = self.recv_exact(length).decode()
+                lines = self.server.status() if command == 'status' else []
+                self.request.sendall(b''.join(
+                    encode_str(line) for line in lines
+                ) + b'\x00\x00')
+        except (EOFError, ConnectionError, OSError):
+            return
+
+
+class FakeApcupsd(BackgroundServer, socketserver.ThreadingTCPServer):
+    """apcupsd Network Information Server (the `status` command)
+
+    The UPS goes on battery for five minutes out of every twenty,
+    draining and then recharging.
+
+    """
+    def __init__(self, address=('127.0.0.1', 3551)):
+        super().__init__(address, NISHandler)
+
+    def status(self):
+        fraction = cycle(20 * 60)
+        on_battery = fraction < 0.25
+        if on_battery:
+            charge = 100.0 - fraction * 200.0
+        else:
+            charge = min(100.0, 50.0 + (fraction - 0.25) * 100.0)
+        values = [
+            ('APC', '001,036,0859'),
+            ('HOSTNAME', 'fake'),
+            ('UPSNAME', 'fake'),
+            ('STATUS', 'ONBATT' if on_battery else 'ONLINE'),
+            ('LINEV', '0.0 Volts' if on_battery else '120.0 Volts'),
+            ('LOADPCT', '15.0 Percent'),
+            ('BCHARGE', f'{charge:.1f} Percent'),
+            ('TIMELEFT', f'{charge * 0.6:.1f} Minutes'),
+        ]
+        lines = [f'{k:9}: {v}\n' for k, v in values]
+        # apcaccess expects the last line to end with two spaces
+        lines.append(f'{"END APC":9}: {time.strftime("%Y-%m-%d %H:%M:%S")}  \n')
+        return lines
+
+
+SERVICES = {
+    'shadow': (FakeShadowBroker, 1883),
+    'shadow-http': (FakeShadowHTTP, 8080),
+    'aws': (FakeAWS, 4566),
+    'octoprint': (FakeOctoPrint, 5000),
+    'open-meteo': (FakeOpenMeteo, 8081),
+    'apcupsd': (FakeApcupsd, 3551),
+}
+
+
+def main():
+    argparser = argparse.ArgumentParser(prog='python -m meter.fakes')
+    argparser.add_argument('service', choices=list(SERVICES))
+    argparser.add_argument('--host', default='127.0.0.1')
+    argparser.add_argument('--port', type=int)
+    options = argparser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    server_type, port = SERVICES[options.service]
+    options.port = options.port or port
+    server = server_type((options.host, options.port))
+    logger.info(f'{options.service} listening on'
+                f' {options.host}:{options.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+import shlex
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from meter import aws, config, sources
+from meter.iot import Meter, role_arn
+from meter.shadow import MqttShadow
+
+logger = logging.getLogger(__name__)
+
+SECTION = 'FLEET'
+
+
+def read_fleet(section=SECTION):
+    """Return {thing name: [source, *source args]} from the config file"""
+    if section not in config.CONFIG:
+        return {}
+    return {
+        thing: shlex.split(line)
+        for thing, line in config.CONFIG[section].items()
+    }
+
+
+class Fleet:
+    """Drive several meter Things from one process
+
+    Things and their sources are listed in the [FLEET] section of the
+    config file, one per line:
+
+        [FLEET]
+        office_meter = OctoPrint --hostname octopi.local
+        desk_meter = Pomodoro --work-time 50
+
+    All meters share one credential manager (and so one pooled
+    iot-data client, or with the mqtt transport one MQTT connection)
+    and one worker pool, and run on a single event loop.
+
+    """
+    def __init__(self, things, min_cycle=4.0, assume_role=None,
+                 transport='https', mqtt_endpoint=None, iot_endpoint=None,
+                 max_workers=None,
+                 **meter_kwargs):
+        # every meter makes blocking shadow calls, so by default give
+        # each one a worker
+        self.max_workers = max_workers or max(16, len(things))
+        self.clients = aws.manager(role_arn(assume_role) if assume_role
+                                   else None)
+        self.clients.pool_size = max(self.clients.pool_size,
+                                     self.max_workers)
+        self.clients.start()
+        self.meters = []
+        self.connection = None
+        if transport == 'mqtt' and things:
+            # one connection (and endpoint lookup) for every Thing
+            self.connection = MqttShadow(
+                next(iter(things)), endpoint=mqtt_endpoint,
+                clients=self.clients
+            )
+
+        for thing, args in things.items():
+            source_type = sources.get_source(args[0])
+            # each line is complete; sharing the [<source>] section would
+            # leak options between lines of the same source
+            source = source_type(args[1:], min_cycle=min_cycle,
+                                 use_config=False)
+            # meters with the same role get the same manager
+            shadow = None
+            if self.connection is not None:
+                shadow = self.connection.shadow(thing)
+            meter = Meter(thing, min_cycle=min_cycle, assume_role=assume_role,
+                          transport=transport, mqtt_endpoint=mqtt_endpoint,
+                          iot_endpoint=iot_endpoint, shadow=shadow,
+                          **meter_kwargs)
+            self.meters.append((meter, source))
+        logger.info(f'Fleet of {len(self.meters)} meters')
+
+    async def run_meter(self, meter, source, executor, offset):
+        # stagger start times so cycles spread evenly over the period
+        await asyncio.sleep(offset)
+        while True:
+            try:
+                await meter.aloop(source, executor=executor)
+            except Exception:
+                logger.exception(f'{meter.thing} failed, restarting')
+                await asyncio.sleep(max(meter.min_cycle, source.min_cycle))
+
+    async def arun(self):
+        executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                      thread_name_prefix='fleet')
+        count = len(self.meters) or 1
+        tasks = [
+            self.run_meter(
+                meter, source, executor,
+                i * max(meter.min_cycle, source.min_cycle) / count
+            )
+            for i, (meter, source) in enumerate(self.meters)
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            executor.shutdown(wait=False)
+
+    def run(self):
+        asyncio.run(self.arun())
+
+    def clear(self):
+        for meter, _ in self.meters:
+            try:
+                meter.clear()
+            except Exception:
+                logger.exception(f'{meter.thing}: clear failed')
+        if self.connection is not None:
+            self.connection.close()
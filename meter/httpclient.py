@@ -0,0 +1,184 @@
+"""Keep-alive HTTP client shared by the sources that poll web APIs
+
+Connections are kept open per host and reused, so a poll of a LAN
+device costs one request rather than a TCP handshake plus a request.
+Connecting and reading have separate timeouts, so a hung device fails
+the cycle instead of stalling the loop. Responses carrying an ETag or
+Last-Modified header are cached, and the next request for the URL is
+made conditional; a 304 returns the cached document.
+"""
+import json
+import zlib
+import socket
+import logging
+import threading
+import http.client
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+
+class HTTPError(Exception):
+    def __init__(self, url, status, body):
+        super().__init__(f'{url}: HTTP {status} {body[:200]!r}')
+        self.status = status
+
+
+class HTTPClient:
+    def __init__(self, connect_timeout=3.0, read_timeout=10.0,
+                 max_idle=4, max_cached=64):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_idle = max_idle
+        self.max_cached = max_cached
+        self.lock = threading.Lock()
+        # (scheme, host, port) -> idle connections
+        self.idle = {}
+        # url -> (validators, document)
+        self.cached = OrderedDict()
+
+    def connect(self, key, read_timeout):
+        scheme, host, port = key
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(host, port,
+                                               timeout=self.connect_timeout)
+        else:
+            conn = http.client.HTTPConnection(host, port,
+                                              timeout=self.connect_timeout)
+        conn.connect()
+        conn.sock.settimeout(read_timeout)
+        return conn
+
+    def checkout(self, key):
+        with self.lock:
+            idle = self.idle.get(key)
+            return idle.pop() if idle else None
+
+    def checkin(self, key, conn):
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def read_body(self, response):
+        """Read the body a chunk at a time, inflating it if compressed"""
+        encoding = response.getheader('Content-Encoding', '')
+        inflate = None
+        if encoding in ('gzip', 'deflate'):
+            # wbits 47 accepts both gzip and zlib headers
+            inflate = zlib.decompressobj(47)
+        parts = []
+        while True:
+            chunk = response.read(65536)
+            if not chunk:
+                break
+            parts.append(inflate.decompress(chunk) if inflate else chunk)
+        if inflate:
+            parts.append(inflate.flush())
+        return b''.join(parts)
+
+    def request(self, method, url, headers=None, body=None, read_timeout=None):
+        """Return (response, body) for a request on a pooled connection"""
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname,
+               parts.port or (443 if parts.scheme == 'https' else 80))
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        headers = dict(headers or {})
+        headers.setdefault('Accept-Encoding', 'gzip')
+        read_timeout = read_timeout or self.read_timeout
+
+        conn = self.checkout(key)
+        reused = conn is not None
+        while True:
+            if conn is None:
+                conn = self.connect(key, read_timeout)
+            else:
+                conn.sock.settimeout(read_timeout)
+            try:
+                conn.request(method, path, body, headers)
+                response = conn.getresponse()
+                payload = self.read_body(response)
+                break
+            except socket.timeout:
+                conn.close()
+                raise
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                conn = None
+                if not reused:
+                    raise
+                # the server closed the idle connection; retry once
+                reused = False
+        if response.will_close:
+            conn.close()
+        else:
+            self.checkin(key, conn)
+        return response, payload
+
+    def get_json(self, url, headers=None, read_timeout=None):
+        """GET and decode a JSON document, revalidating a cached copy"""
+        headers = dict(headers or {})
+        with self.lock:
+            cached = self.cached.get(url)
+        if cached:
+            validators, _ = cached
+            if 'etag' in validators:
+                headers['If-None-Match'] = validators['etag']
+            if 'last-modified' in validators:
+                headers['If-Modified-Since'] = validators['last-modified']
+
+        response, payload = self.request('GET', url, headers,
+                                         read_timeout=read_timeout)
+        if response.status == 304 and cached:
+            logger.debug(f'{url}: not modified')
+            return cached[1]
+        if response.status >= 300:
+            raise HTTPError(url, response.status, payload)
+        document = json.loads(payload)
+
+        validators = {
+            k: response.getheader(k) for k in ('etag', 'last-modified')
+            if response.getheader(k)
+        }
+        with self.lock:
+            self.cached.pop(url, None)
+            if validators:
+                self.cached[url] = (validators, document)
+                while len(self.cached) > self.max_cached:
+                    self.cached.popitem(last=False)
+        return document
+
+    def post_json(self, url, document, headers=None, read_timeout=None):
+        """POST a JSON document and decode the JSON response"""
+        headers = dict(headers or {}, **{'Content-Type': 'application/json'})
+        response, payload = self.request('POST', url, headers,
+                                         json.dumps(document).encode(),
+                                         read_timeout=read_timeout)
+        if response.status >= 300:
+            raise HTTPError(url, response.status, payload)
+        return json.loads(payload)
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+
+CLIENT = HTTPClient()
+
+
+def get_json(url, headers=None, read_timeout=None):
+    """GET a JSON document with the shared client"""
+    return CLIENT.get_json(url, headers, read_timeout)
+
+
+def post_json(url, document, headers=None, read_timeout=None):
+    """POST a JSON document with the shared client"""
+    return CLIENT.post_json(url, document, headers, read_timeout)
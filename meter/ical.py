@@ -0,0 +1,376 @@
+"""Minimal iCalendar (.ics) reader for today's meetings
+
+Parses VEVENTs from an .ics file, or every .ics file in a directory
+(e.g. a CalDAV collection synced with vdirsyncer), once per change of
+their modification times. For each day the events, with recurrences
+expanded, are kept sorted by start so the current and next meeting are
+found with a bisect.
+
+Recurrence rules support FREQ=DAILY/WEEKLY/MONTHLY/YEARLY with
+INTERVAL, COUNT, UNTIL, BYDAY (including ordinals such as 2TU or
+-1FR), BYMONTHDAY and BYMONTH, plus EXDATE and moved or cancelled
+instances (RECURRENCE-ID). All-day, cancelled and transparent
+(free) events are skipped.
+"""
+import os
+import logging
+from bisect import bisect_right
+from calendar import monthrange
+from datetime import datetime, time, timedelta, timezone
+
+try:
+    import zoneinfo
+    has_zoneinfo = True
+except ImportError:
+    has_zoneinfo = False
+
+logger = logging.getLogger(__name__)
+
+WEEKDAYS = ['MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU']
+# stop counting COUNT occurrences after this many days
+MAX_SCAN_DAYS = 20 * 366
+
+
+def unfold(text):
+    """Yield logical content lines, joining folded continuations"""
+    line = None
+    for raw in text.splitlines():
+        if raw[:1] in (' ', '\t') and line is not None:
+            line += raw[1:]
+            continue
+        if line:
+            yield line
+        line = raw
+    if line:
+        yield line
+
+
+def parse_line(line):
+    """Return (NAME, {PARAM: value}, value) for a content line"""
+    quoted = False
+    for i, c in enumerate(line):
+        if c == '"':
+            quoted = not quoted
+        elif c == ':' and not quoted:
+            break
+    else:
+        return line.upper(), {}, ''
+    name, *params = line[:i].split(';')
+    params = dict(
+        (p.split('=', 1) + [''])[:2] for p in params
+    )
+    params = {k.upper(): v.strip('"') for k, v in params.items()}
+    return name.upper(), params, line[i + 1:]
+
+
+def tz(tzid):
+    if not has_zoneinfo:
+        return None
+    try:
+        return zoneinfo.ZoneInfo(tzid)
+    except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+        # e.g. Windows names from Outlook; treated as local time
+        return None
+
+
+def parse_time(value, params):
+    """Return a date for all-day values, else a datetime
+
+    UTC values and those with a known TZID are timezone-aware; floating
+    times are naive and taken as local.
+
+    """
+    value = value.strip()
+    if params.get('VALUE') == 'DATE' or len(value) == 8:
+        return datetime.strptime(value[:8], '%Y%m%d').date()
+    dt = datetime.strptime(value[:15], '%Y%m%dT%H%M%S')
+    if value.endswith('Z'):
+        return dt.replace(tzinfo=timezone.utc)
+    if 'TZID' in params:
+        zone = tz(params['TZID'])
+        if zone is not None:
+            return dt.replace(tzinfo=zone)
+    return dt
+
+
+def parse_duration(value):
+    sign = -1 if value.startswith('-') else 1
+    value = value.lstrip('+-').lstrip('P')
+    seconds, number = 0, ''
+    units = {'W': 604800, 'D': 86400, 'H': 3600, 'M': 60, 'S': 1}
+    for c in value:
+        if c.isdigit():
+            number += c
+        elif c in units:
+            seconds += int(number or 0) * units[c]
+            number = ''
+    return timedelta(seconds=sign * seconds)
+
+
+def local(dt):
+    """Convert to a naive local datetime, like datetime.now()"""
+    if dt.tzinfo is not None:
+        return dt.astimezone().replace(tzinfo=None)
+    return dt
+
+
+class Event:
+    def __init__(self, props):
+        self.uid = props.get('UID', (None, {}, ''))[2]
+        self.summary = props.get('SUMMARY', (None, {}, ''))[2]
+        self.start = parse_time(props['DTSTART'][2], props['DTSTART'][1])
+        if 'DTEND' in props:
+            end = parse_time(props['DTEND'][2], props['DTEND'][1])
+            if isinstance(end, datetime) and isinstance(self.start, datetime) \
+               and (end.tzinfo is None) != (self.start.tzinfo is None):
+                end = end.replace(tzinfo=self.start.tzinfo)
+            self.duration = end - self.start
+        elif 'DURATION' in props:
+            self.duration = parse_duration(props['DURATION'][2])
+        else:
+            self.duration = timedelta(0)
+        self.rule = None
+        if 'RRULE' in props:
+            self.rule = dict(
+                p.split('=', 1) for p in props['RRULE'][2].split(';') if '=' in p
+            )
+        self.exdates = set()
+        for params, value in props.get('EXDATE*', []):
+            for v in value.split(','):
+                t = parse_time(v, params)
+                # a date excludes every instance starting that day
+                self.exdates.add(local(t) if isinstance(t, datetime) else t)
+        self.recurrence_id = None
+        if 'RECURRENCE-ID' in props:
+            name, params, value = props['RECURRENCE-ID']
+            self.recurrence_id = local(parse_time(value, params))
+        self.skip = (
+            not isinstance(self.start, datetime)
+            or props.get('STATUS', (None, {}, ''))[2].upper() == 'CANCELLED'
+            or props.get('TRANSP', (None, {}, ''))[2].upper() == 'TRANSPARENT'
+        )
+        self.until = None
+        self.last_date = None
+        if self.rule and not self.skip:
+            if 'UNTIL' in self.rule:
+                until = parse_time(self.rule['UNTIL'], {})
+                if not isinstance(until, datetime):
+                    until = datetime.combine(until, time.max)
+                self.until = local(until)
+            if 'COUNT' in self.rule:
+                self.last_date = self.count_end(int(self.rule['COUNT']))
+
+    def count_end(self, count):
+        """Date of the last of `count` occurrences"""
+        day = self.start.date()
+        for _ in range(MAX_SCAN_DAYS):
+            if matches(self.rule, self.start, day):
+                count -= 1
+                if not count:
+                    return day
+            day += timedelta(days=1)
+        return day
+
+    def occurrences(self, day):
+        """Yield naive local (start, end) of instances overlapping day"""
+        day_start = datetime.combine(day, time.min)
+        day_end = day_start + timedelta(days=1)
+        if self.rule is None:
+            candidates = [self.start]
+        else:
+            # the event's own timezone may be on a different date
+            candidates = [
+                self.start.replace(year=d.year, month=d.month, day=d.day)
+                for d in (day - timedelta(days=1), day, day + timedelta(days=1))
+                if matches(self.rule, self.start, d)
+                and (self.last_date is None or d <= self.last_date)
+            ]
+        for start in candidates:
+            end = local(start + self.duration)
+            start = local(start)
+            if self.rule is not None and (
+                start in self.exdates or start.date() in self.exdates
+                or (self.until is not None and start > self.until)
+            ):
+                continue
+            if start < day_end and end > day_start:
+                yield start, end
+
+
+def ints(value):
+    return [int(v) for v in value.split(',')]
+
+
+def weekday_matches(spec, day):
+    """Match a BYDAY entry like TU, 2TU or -1FR against day"""
+    if WEEKDAYS[day.weekday()] != spec[-2:]:
+        return False
+    if len(spec) == 2:
+        return True
+    n = int(spec[:-2])
+    if n > 0:
+        return (day.day - 1) // 7 + 1 == n
+    return (monthrange(day.year, day.month)[1] - day.day) // 7 + 1 == -n
+
+
+def monthday_matches(monthdays, day):
+    last = monthrange(day.year, day.month)[1]
+    return any(md == day.day or (md < 0 and last + md + 1 == day.day)
+               for md in monthdays)
+
+
+def matches(rule, start, day):
+    """Whether a rule starting at start has an instance on date day"""
+    if day < start.date():
+        return False
+    freq = rule.get('FREQ')
+    interval = int(rule.get('INTERVAL', 1))
+    byday = rule['BYDAY'].split(',') if 'BYDAY' in rule else None
+    if 'BYMONTH' in rule and day.month not in ints(rule['BYMONTH']):
+        return False
+    monthdays = ints(rule['BYMONTHDAY']) if 'BYMONTHDAY' in rule else None
+
+    if freq == 'DAILY':
+        if (day - start.date()).days % interval:
+            return False
+        return byday is None or WEEKDAYS[day.weekday()] in \
+            [d[-2:] for d in byday]
+    if freq == 'WEEKLY':
+        wkst = WEEKDAYS.index(rule.get('WKST', 'MO'))
+
+        def week(d):
+            return d - timedelta(days=(d.weekday() - wkst) % 7)
+        if ((week(day) - week(start.date())).days // 7) % interval:
+            return False
+        return WEEKDAYS[day.weekday()] in (byday or [WEEKDAYS[start.weekday()]])
+    if freq == 'MONTHLY':
+        months = (day.year - start.year) * 12 + day.month - start.month
+        if months % interval:
+            return False
+        if byday:
+            return any(weekday_matches(d, day) for d in byday)
+        return monthday_matches(monthdays or [start.day], day)
+    if freq == 'YEARLY':
+        if (day.year - start.year) % interval:
+            return False
+        if 'BYMONTH' not in rule and day.month != start.month:
+            return False
+        if byday:
+            return any(weekday_matches(d, day) for d in byday)
+        return monthday_matches(monthdays or [start.day], day)
+    return False
+
+
+def parse(text):
+    """Return the Events in an iCalendar document"""
+    events = []
+    props = None
+    depth = 0
+    for line in unfold(text):
+        name, params, value = parse_line(line)
+        if name == 'BEGIN':
+            if value.upper() == 'VEVENT':
+                props, depth = {}, 0
+            elif props is not None:
+                # VALARM etc. inside the event
+                depth += 1
+        elif name == 'END' and props is not None:
+            if depth:
+                depth -= 1
+            elif value.upper() == 'VEVENT':
+                if 'DTSTART' in props:
+                    try:
+                        events.append(Event(props))
+                    except ValueError:
+                        logger.warning(f'skipping unparseable event'
+                                       f' {props.get("SUMMARY")}')
+                props = None
+        elif props is not None and not depth:
+            if name == 'EXDATE':
+                props.setdefault('EXDATE*', []).append((params, value))
+            else:
+                props[name] = (name, params, value)
+    return events
+
+
+class Calendar:
+    """Today's meetings from an .ics file or directory of .ics files"""
+
+    def __init__(self, path):
+        self.path = path
+        self.signature = None
+        self.events = []
+        self.day = None
+        self.starts = []
+        self.index = []
+        self.longest = timedelta(0)
+
+    def files(self):
+        if os.path.isdir(self.path):
+            return sorted(
+                os.path.join(self.path, f) for f in os.listdir(self.path)
+                if f.endswith('.ics')
+            )
+        return [self.path]
+
+    def refresh(self):
+        """Re-parse if any file changed, return True if it did"""
+        files = self.files()
+        signature = [(f, os.stat(f).st_mtime_ns) for f in files]
+        if signature == self.signature:
+            return False
+        events = []
+        for f in files:
+            with open(f, encoding='utf-8', errors='replace') as fp:
+                events += parse(fp.read())
+        self.events = events
+        self.signature = signature
+        self.day = None
+        logger.info(f'{self.path}: {len(events)} events')
+        return True
+
+    def build(self, day):
+        moved = {(e.uid, e.recurrence_id) for e in self.events
+                 if e.recurrence_id is not None}
+        index = []
+        for event in self.events:
+            # cancelled instances are dropped from the series via `moved`
+            if event.skip:
+                continue
+            for start, end in event.occurrences(day):
+                if event.rule is not None and (event.uid, start) in moved:
+                    continue
+                if end <= start:
+                    # reminders and other zero-length entries
+                    continue
+                index.append((start, end, event.summary))
+        index.sort()
+        self.day = day
+        self.index = index
+        self.starts = [start for start, _, _ in index]
+        self.longest = max((end - start for start, end, _ in index),
+                           default=timedelta(0))
+
+    def lookup(self, now):
+        """Return (start, end, summary) of the current or next meeting
+
+        When meetings overlap, the current one is the one ending
+        soonest. Returns None when nothing is left today.
+
+        """
+        if self.day != now.date():
+            self.build(now.date())
+        i = bisect_right(self.starts, now)
+        current = None
+        # only meetings starting within `longest` of now can be running
+        j = i - 1
+        while j >= 0 and self.starts[j] >= now - self.longest:
+            start, end, summary = self.index[j]
+            if end > now and (current is None or end < current[1]):
+                current = self.index[j]
+            j -= 1
+        if current is not None:
+            return current
+        if i < len(self.index):
+            return self.index[i]
+        return None
@@ -1,10 +1,14 @@
 import json
 import time
-import boto3
+import random
+import asyncio
 import logging
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 
-from meter.utils import c_to_f
+from meter import aws
+from meter.stats import STATS
+from meter.utils import c_to_f, merge, quantize, CHANNELS
+from meter.shadow import BotoShadow, MqttShadow, SigV4Shadow
 
 logger = logging.getLogger(__name__)
 
@@ -20,6 +24,7 @@ def is_account_id(v):
 
 
 def create_assume_role(from_acct_id):
+    import boto3
     role = 'meter-update'
     sts = boto3.client('sts')
     my_account_id = sts.get_caller_identity()['Account']
@@ -55,109 +60,380 @@ def create_assume_role(from_acct_id):
             Description='get and push IoT data plane updates',
             MaxSessionDuration=12*60*60,
         )
-        response = iam.put_role_policy(
-            RoleName=role,
-            PolicyName='iot-data',
-            PolicyDocument=json.dumps({
-                "Version": "2012-10-17",
-                "Statement": [{
-                    "Effect": "Allow",
-                    "Action": [
-                        "iot:GetThingShadow",
-                        "iot:UpdateThingShadow"
-                    ],
-                    "Resource": f"arn:aws:iot:*:{my_account_id}:thing/*"
-                }]
-            })
-        )
+
+    # also on an existing role, which may predate the MQTT statements
+    iam.put_role_policy(
+        RoleName=role,
+        PolicyName='iot-data',
+        PolicyDocument=json.dumps({
+            "Version": "2012-10-17",
+            "Statement": [{
+                "Effect": "Allow",
+                "Action": [
+                    "iot:GetThingShadow",
+                    "iot:UpdateThingShadow"
+                ],
+                "Resource": f"arn:aws:iot:*:{my_account_id}:thing/*"
+            }, {
+                "Effect": "Allow",
+                "Action": "iot:DescribeEndpoint",
+                "Resource": "*"
+            }, {
+                "Effect": "Allow",
+                "Action": "iot:Connect",
+                "Resource": f"arn:aws:iot:*:{my_account_id}:client/meter-*"
+            }, {
+                "Effect": "Allow",
+                "Action": ["iot:Publish", "iot:Receive"],
+                "Resource": (f"arn:aws:iot:*:{my_account_id}"
+                             ":topic/$aws/things/*/shadow/*")
+            }, {
+                "Effect": "Allow",
+                "Action": "iot:Subscribe",
+                "Resource": (f"arn:aws:iot:*:{my_account_id}"
+                             ":topicfilter/$aws/things/*/shadow/*")
+            }]
+        })
+    )
     
 
-class DelayCycler:
-    def __init__(self, min_cycle):
+def role_arn(assume_role):
+    if is_account_id(assume_role):
+        return ROLE_ARN_TEMPLATE.format(account_id=assume_role)
+    assert assume_role.startswith('arn:aws:')
+    return assume_role
+
+
+class Scheduler:
+    """Choose the delay between polling cycles
+
+    Uses the monotonic clock. After a failure the next cycle is delayed
+    by an exponential backoff with jitter; while the source value keeps
+    changing the fast cycle is used, and once it has been flat for
+    idle_after seconds the idle cycle is used. A wakeup time hinted by
+    the source takes precedence over all but backoff. The reason for
+    the last choice is kept in `reason`.
+
+    """
+    def __init__(self, min_cycle, fast_cycle=None, idle_cycle=None,
+                 idle_after=300.0, max_backoff=300.0, min_hint=None,
+                 max_hint=300.0):
         self.min_cycle = min_cycle
-        self.next_cycle = 0.0
+        self.fast_cycle = fast_cycle or min_cycle
+        self.idle_cycle = idle_cycle or min_cycle
+        self.idle_after = idle_after
+        self.max_backoff = max_backoff
+        # hints never wake us more often than the fast cycle
+        self.min_hint = min_hint or self.fast_cycle
+        self.max_hint = max_hint
+        self.wakeup = None
+        self.failures = 0
+        self.changed = False
+        self.started = self.next_cycle = time.monotonic()
+        self.last_change = self.started
+        self.reason = 'start'
 
-    def cycle(self):
-        now = time.time()
-        delay = self.next_cycle - now
-        if delay > 0:
-            time.sleep(delay)
-        self.next_cycle = time.time() + self.min_cycle
+    def interval(self):
+        now = time.monotonic()
+        if self.failures:
+            backoff = min(self.max_backoff,
+                          self.min_cycle * 2 ** self.failures)
+            return (random.uniform(backoff / 2, backoff),
+                    f'backoff after {self.failures} failures')
+        if self.wakeup is not None:
+            # the hint is wall-clock time, convert it to a delay from start
+            delay = self.wakeup - time.time() + (now - self.started)
+            delay = min(self.max_hint, max(self.min_hint, delay))
+            return delay, 'source hint'
+        if self.changed:
+            return self.fast_cycle, 'changing'
+        flat = now - self.last_change
+        if flat > self.idle_after:
+            return self.idle_cycle, f'flat for {int(flat)}s'
+        return self.min_cycle, 'steady'
+
+    def plan(self):
+        interval, self.reason = self.interval()
+        self.next_cycle = self.started + interval
+        logger.debug(f'Next cycle in {interval:.1f}s ({self.reason})')
+
+    def success(self, changed, wakeup=None):
+        self.failures = 0
+        self.changed = changed
+        self.wakeup = wakeup
+        if changed:
+            self.last_change = time.monotonic()
+        self.plan()
+
+    def failure(self):
+        self.failures += 1
+        self.changed = False
+        self.wakeup = None
+        self.plan()
+
+    def delay(self):
+        return max(0.0, self.next_cycle - time.monotonic())
+
+    def start(self):
+        self.started = time.monotonic()
         return True
 
+    def cycle(self):
+        time.sleep(self.delay())
+        return self.start()
 
 
 class Meter:
-    def __init__(self, thing, min_cycle=4.0, assume_role=None, show_temp=False):
+    def __init__(self, thing, min_cycle=4.0, assume_role=None, show_temp=False,
+                 transport='https', mqtt_endpoint=None, iot_endpoint=None,
+                 write_only=False,
+                 resync=300.0, deadband=None, pwm_resolution=65535,
+                 shadow=None, fast_cycle=None, idle_cycle=None,
+                 idle_after=300.0, recorder=None):
         self.thing = thing
         self.min_cycle = min_cycle
         self.assume_role = assume_role
         self.show_temp = show_temp
+        self.write_only = write_only
+        self.resync = resync
+        self.mirror = None
+        self.last_sync = None
+        self.deadband = deadband or {}
+        self.pwm_resolution = pwm_resolution
+        self.fast_cycle = fast_cycle
+        self.idle_cycle = idle_cycle
+        self.idle_after = idle_after
+        self.stats = STATS
+        self.recorder = recorder
         
+        self.assume_role_arn = None
         if self.assume_role:
-            if is_account_id(self.assume_role):
-                self.assume_role_arn = ROLE_ARN_TEMPLATE.format(
-                    account_id=self.assume_role
-                )
-            else:
-                assert self.assume_role.startswith('arn:aws:')
-                self.assume_role_arn = self.assume_role
-
-            self.credentials = {'Expiration': datetime.now().astimezone()}
+            self.assume_role_arn = role_arn(self.assume_role)
+        # credentials are refreshed in the background by the manager,
+        # which sources can share through Meter.clients
+        self.clients = aws.manager(self.assume_role_arn)
+        self.clients.start()
+        self.mqtt_endpoint = mqtt_endpoint
 
+        if shadow is not None:
+            # shared with other meters, e.g. by Fleet
+            self.shadow = shadow
+        elif transport == 'mqtt':
+            self.shadow = MqttShadow(
+                thing, endpoint=mqtt_endpoint, clients=self.clients
+            )
+        elif transport == 'sigv4':
+            self.shadow = SigV4Shadow(
+                thing, clients=self.clients, endpoint=iot_endpoint
+            )
         else:
-            self.iot = boto3.client('iot-data')
+            self.shadow = BotoShadow(
+                thing, clients=self.clients, endpoint=iot_endpoint
+            )
+            
+    def sync(self):
+        with self.stats.timer('sync', self.thing):
+            self.mirror = self.shadow.get()
+        self.mirror.setdefault('state', {})
+        self.mirror.setdefault('metadata', {})
+        self.last_sync = time.monotonic()
+        logger.debug(f'Synced shadow version {self.mirror.get("version")}')
 
-    def refresh_credentials(self):
-        if not self.assume_role:
+    def apply(self, response, update):
+        """Fold a shadow update response into the local mirror"""
+        if self.mirror is None:
             return
+        if response is None:
+            # the update was published (MQTT); the full document arrives
+            # later, so assume the write went through
+            merge(self.mirror['state'].setdefault('desired', {}), update)
+            return
+        merge(self.mirror['state'], response.get('state', {}))
+        merge(self.mirror['metadata'], response.get('metadata', {}))
+        # a version gap is almost always the device acknowledging our
+        # last write in reported, which the mirror only needs when the
+        # source reads it (and then needs_sync reads every cycle);
+        # desired written by others is picked up by the periodic resync
+        self.mirror['version'] = response.get('version')
+
+    def needs_sync(self, source):
+        if not self.write_only or self.mirror is None or self.last_sync is None:
+            return True
+        if source.USES_REPORTED or self.show_temp:
+            return True
+        return time.monotonic() - self.last_sync > self.resync
+
+    def quantize(self, desired):
+        return {
+            k: quantize(v, self.pwm_resolution)
+            if k in CHANNELS and isinstance(v, (int, float)) else v
+            for k, v in desired.items()
+        }
+
+    def changes(self, desired, current):
+        """Return the keys of desired that moved outside their deadband"""
+        update = {}
+        for k, v in desired.items():
+            if k not in current:
+                update[k] = v
+            elif isinstance(v, (int, float)) and \
+                 isinstance(current[k], (int, float)):
+                if abs(v - current[k]) > self.deadband.get(k, 0.0):
+                    update[k] = v
+            elif v != current[k]:
+                update[k] = v
+        return update
+
+    def reported(self):
+        reported = self.mirror['state'].get('reported', {})
+        logger.debug(f'Reported: {reported}')
+        self.record('reported', reported)
+        if self.show_temp:
+            temp_f = c_to_f(reported['temp'])
+            logger.info(f'Meter temperature: {temp_f:.1f} F')
+        return reported
+
+    def pending(self, desired, reported):
+        """Return the partial desired document that should be written"""
+        desired = self.quantize(desired)
+        if self.write_only:
+            current = self.mirror['state'].get('desired', {})
+        else:
+            current = reported
+        return self.changes(desired, current)
+
+    def write(self, update):
+        logger.debug(f'Update: {update}')
+        with self.stats.timer('write', self.thing):
+            response = self.shadow.update(update)
+        self.stats.incr('writes', thing=self.thing)
+        self.apply(response, update)
+
+    def skip(self):
+        self.stats.incr('writes_skipped', thing=self.thing)
+
+    def warn_write_only(self, source):
+        if self.write_only and source.USES_REPORTED:
+            logger.warning(f'{source.__class__.__name__} reads reported state,'
+                           f' shadow will be read every cycle')
+
+    def step(self):
+        """Smallest meter change worth waking up for"""
+        return max(100.0 / self.pwm_resolution, self.deadband.get('meter', 0.0))
+
+    def scheduler(self, source):
+        min_cycle = max(self.min_cycle, source.min_cycle)
+        fast_cycle = self.fast_cycle
+        if fast_cycle and source.min_cycle > self.min_cycle:
+            # the source asked for a longer cycle, e.g. for API limits
+            fast_cycle = max(fast_cycle, source.min_cycle)
+        return Scheduler(min_cycle, fast_cycle=fast_cycle,
+                         idle_cycle=self.idle_cycle,
+                         idle_after=self.idle_after)
+
+    def record(self, kind, values):
+        if self.recorder:
+            self.recorder.record(kind, values)
+
+    def cycle(self, source):
+        """Run one polling cycle, return the update written (if any)"""
+        with self.stats.timer('cycle', self.thing):
+            if self.needs_sync(source):
+                self.sync()
+            reported = self.reported()
+            with self.stats.timer('source', self.thing):
+                desired = source.update(reported)
+            self.record('desired', desired)
+            update = self.pending(desired, reported)
+            if update:
+                self.write(update)
+            else:
+                self.skip()
+        return update
 
-        remaining = self.credentials['Expiration'] - datetime.now().astimezone()
-        if remaining < timedelta(seconds=3600):
-            sts = boto3.client('sts')
-            response = sts.assume_role(
-                RoleArn=self.assume_role_arn,
-                RoleSessionName='meter',
-                DurationSeconds=12*60*60
-            )
-            self.credentials = response['Credentials']
-            self.credentials['Expiration'] = self.credentials['Expiration']\
-                .astimezone()
-            logger.info(f'Refreshed credentials,'
-                        f' expiration {self.credentials["Expiration"]}')
-            self.iot = boto3.client(
-                'iot-data',
-                aws_access_key_id=self.credentials['AccessKeyId'],
-                aws_secret_access_key=self.credentials['SecretAccessKey'],
-                aws_session_token=self.credentials['SessionToken']
-            )
-            
     def loop(self, source):
-        cycler = DelayCycler(max(self.min_cycle, source.min_cycle))
-        while cycler.cycle():
-            self.refresh_credentials()
-            response = self.iot.get_thing_shadow(thingName=self.thing)
-            reported = json.load(response['payload'])['state']['reported']
-            logger.debug(f'Reported: {reported}')
-            if self.show_temp:
-                temp_f = c_to_f(reported['temp'])
-                logger.info(f'Meter temperature: {temp_f:.1f} F')
-            desired = source.update(reported)
-            if desired != reported:
-                logger.debug(f'Update: {desired}')
-                self.iot.update_thing_shadow(
-                    thingName=self.thing,
-                    payload=json.dumps({'state': {'desired': desired}}).encode()
-                )
+        self.warn_write_only(source)
+        source.bind(self)
+        scheduler = self.scheduler(source)
+        while scheduler.cycle():
+            try:
+                update = self.cycle(source)
+            except Exception:
+                logger.exception(f'{self.thing}: cycle failed')
+                scheduler.failure()
+            else:
+                scheduler.success(bool(update), source.next_update(self.step()))
+
+    async def aloop(self, source, max_workers=4, executor=None):
+        """asyncio version of loop()
+
+        Blocking calls (shadow I/O and sources
+        without a native aupdate()) run on a bounded thread pool. When
+        the source does not read the reported state, the shadow read
+        and the source fetch run concurrently. A shared executor may be
+        passed in, in which case it is left running on exit.
+
+        """
+        self.warn_write_only(source)
+        loop = asyncio.get_running_loop()
+        own_executor = executor is None
+        if own_executor:
+            executor = ThreadPoolExecutor(max_workers=max_workers,
+                                          thread_name_prefix='meter')
+
+        def run(func, *args):
+            return loop.run_in_executor(executor, func, *args)
+
+        scheduler = self.scheduler(source)
+        try:
+            # may block, e.g. waiting for a first push; other meters
+            # share this event loop
+            await run(source.bind, self)
+            while True:
+                await asyncio.sleep(scheduler.delay())
+                scheduler.start()
+                try:
+                    with self.stats.timer('cycle', self.thing):
+                        update = await self.acycle(source, run, executor)
+                except Exception:
+                    logger.exception(f'{self.thing}: cycle failed')
+                    scheduler.failure()
+                else:
+                    scheduler.success(bool(update),
+                                      source.next_update(self.step()))
+        finally:
+            if own_executor:
+                executor.shutdown(wait=False)
+
+    async def acycle(self, source, run, executor):
+        sync = self.needs_sync(source)
+        if sync and (source.USES_REPORTED or self.mirror is None):
+            await run(self.sync)
+            sync = False
+        reported = self.reported()
+
+        async def fetch():
+            with self.stats.timer('source', self.thing):
+                return await source.aupdate(reported, executor)
+
+        if sync:
+            desired, _ = await asyncio.gather(fetch(), run(self.sync))
+        else:
+            desired = await fetch()
+        self.record('desired', desired)
+        update = self.pending(desired, self.mirror['state'].get(
+            'reported', {}))
+        if update:
+            await run(self.write, update)
+        else:
+            self.skip()
+        return update
 
     def clear(self):
-        self.refresh_credentials()
-        self.iot.update_thing_shadow(
-            thingName=self.thing,
-            payload=json.dumps({'state': {'desired': {
-                'meter': 0.0,
-                'red': 0.0,
-                'green': 0.0,
-                'blue': 0.0,
-            }}})
-        )
+        self.shadow.update({
+            'meter': 0.0,
+            'red': 0.0,
+            'green': 0.0,
+            'blue': 0.0,
+        })
+        self.shadow.close()
@@ -0,0 +1,325 @@
+"""Record source readings and replay or analyze them offline
+
+    meter OctoPrint --hostname octopi.local --record octoprint.mlog
+
+appends every reported shadow state and every source update to a
+columnar log: each flushed chunk holds one packed array per column
+(time, kind and one float32 per channel, NaN where a value is absent).
+
+    meter --replay octoprint.mlog --deadband 0.5
+
+runs the meter's cycle logic (quantizing, deadband, write-only mirror)
+over the log against an in-memory shadow, as fast as possible.
+
+    python -m meter.record octoprint.mlog --deadband 0 0.5 2 --period 0 30
+
+reports the update rate and change distribution, and how many shadow
+writes each deadband and period would have caused. Analysis needs
+numpy.
+"""
+import sys
+import json
+import time
+import array
+import struct
+import logging
+import argparse
+import threading
+
+try:
+    import numpy as np
+    has_numpy = True
+except ImportError:
+    has_numpy = False
+
+from meter.utils import merge, parse_channels, CHANNELS
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'METERLOG'
+VERSION = 1
+REPORTED, DESIRED = 0, 1
+KINDS = {'reported': REPORTED, 'desired': DESIRED}
+VALUES = CHANNELS + ('temp',)
+COLUMNS = (('time', 'd'), ('kind', 'B')) + tuple((k, 'f') for k in VALUES)
+NAN = float('nan')
+
+
+class Recorder:
+    """Append rows to a log, one chunk of column arrays at a time"""
+
+    def __init__(self, path, source=None, uses_reported=True, chunk_rows=256):
+        self.chunk_rows = chunk_rows
+        self.lock = threading.Lock()
+        self.columns = {name: array.array(code) for name, code in COLUMNS}
+        self.fp = open(path, 'wb')
+        header = json.dumps({
+            'columns': COLUMNS,
+            'source': source,
+            'uses_reported': uses_reported,
+        }).encode()
+        self.fp.write(MAGIC + struct.pack('<BI', VERSION, len(header))
+                      + header)
+
+    def record(self, kind, values, timestamp=None):
+        with self.lock:
+            self.columns['time'].append(timestamp or time.time())
+            self.columns['kind'].append(KINDS[kind])
+            for k in VALUES:
+                v = values.get(k)
+                self.columns[k].append(
+                    v if isinstance(v, (int, float)) else NAN
+                )
+            if len(self.columns['time']) >= self.chunk_rows:
+                self.write_chunk()
+
+    def write_chunk(self):
+        rows = len(self.columns['time'])
+        if not rows:
+            return
+        self.fp.write(struct.pack('<I', rows))
+        for name, code in COLUMNS:
+            column = self.columns[name]
+            if sys.byteorder == 'big':
+                column.byteswap()
+            self.fp.write(column.tobytes())
+            self.columns[name] = array.array(code)
+        self.fp.flush()
+
+    def close(self):
+        with self.lock:
+            self.write_chunk()
+            self.fp.close()
+
+
+def read_log(path):
+    """Return (header, {column: array.array}) for every row in the log"""
+    columns = {name: array.array(code) for name, code in COLUMNS}
+    with open(path, 'rb') as fp:
+        if fp.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not a meter log')
+        version, length = struct.unpack('<BI', fp.read(5))
+        if version != VERSION:
+            raise ValueError(f'{path}: unsupported log version {version}')
+        header = json.loads(fp.read(length))
+        while True:
+            prefix = fp.read(4)
+            if len(prefix) < 4:
+                break
+            rows = struct.unpack('<I', prefix)[0]
+            for name, code in COLUMNS:
+                chunk = array.array(code)
+                data = fp.read(rows * chunk.itemsize)
+                if len(data) < rows * chunk.itemsize:
+                    # the recorder was killed mid-chunk
+                    logger.warning(f'{path}: truncated chunk ignored')
+                    return header, trim(columns)
+                chunk.frombytes(data)
+                if sys.byteorder == 'big':
+                    chunk.byteswap()
+                columns[name].extend(chunk)
+    return header, columns
+
+
+def trim(columns):
+    rows = min(len(c) for c in columns.values())
+    return {name: c[:rows] for name, c in columns.items()}
+
+
+def rows(columns):
+    """Yield (time, kind, values) with absent values left out"""
+    for i, (t, kind) in enumerate(zip(columns['time'], columns['kind'])):
+        values = {}
+        for k in VALUES:
+            v = columns[k][i]
+            if v == v:
+                values[k] = v
+        yield t, kind, values
+
+
+class ReplayShadow:
+    """In-memory shadow whose reported state is set from a log"""
+
+    def __init__(self):
+        self.document = {
+            'state': {'desired': {}, 'reported': {}},
+            'metadata': {},
+            'version': 0,
+        }
+
+    def report(self, values):
+        # a device update, so it bumps the version like the real thing
+        merge(self.document['state']['reported'], values)
+        self.document['version'] += 1
+
+    def get(self):
+        state = self.document['state']
+        return {
+            'state': {k: dict(v) for k, v in state.items()},
+            'metadata': {},
+            'version': self.document['version'],
+        }
+
+    def update(self, desired):
+        merge(self.document['state']['desired'], desired)
+        self.document['version'] += 1
+        return {
+            'state': {'desired': desired},
+            'metadata': {},
+            'version': self.document['version'],
+        }
+
+    def close(self):
+        pass
+
+
+class ReplaySource:
+    """Returns the recorded source update for the current row"""
+
+    def __init__(self, header):
+        self.USES_REPORTED = header.get('uses_reported', True)
+        self.min_cycle = 0.0
+        self.desired = {}
+
+    def update(self, reported):
+        return self.desired
+
+    def next_update(self, step):
+        return None
+
+
+def replay(meter, path):
+    """Run meter's cycle logic over a log, return the number of cycles"""
+    header, columns = read_log(path)
+    source = ReplaySource(header)
+    cycles = 0
+    for _, kind, values in rows(columns):
+        if kind == REPORTED:
+            meter.shadow.report(values)
+            continue
+        source.desired = values
+        try:
+            meter.cycle(source)
+        except Exception:
+            logger.exception('replayed cycle failed')
+        cycles += 1
+    return cycles
+
+
+def simulate_writes(t, values, deadband, period):
+    """Count the shadow writes Meter would make sampling every period"""
+    if period:
+        ticks = np.arange(t[0], t[-1], period)
+        values = values[np.searchsorted(t, ticks, side='right') - 1]
+    current = np.full(values.shape[1], np.nan)
+    writes = 0
+    for row in values:
+        present = ~np.isnan(row)
+        with np.errstate(invalid='ignore'):
+            moved = present & (np.isnan(current)
+                               | (np.abs(row - current) > deadband))
+        if moved.any():
+            writes += 1
+            current[moved] = row[moved]
+    return writes
+
+
+def analyze(path, deadbands, periods, pwm_resolution):
+    header, columns = read_log(path)
+    t = np.frombuffer(columns['time'], dtype=np.float64)
+    kind = np.frombuffer(columns['kind'], dtype=np.uint8)
+    desired = kind == DESIRED
+    t = t[desired]
+    if len(t) < 2:
+        raise ValueError(f'{path}: fewer than two source updates recorded')
+    values = np.stack([
+        np.frombuffer(columns[k], dtype=np.float32)[desired]
+        for k in CHANNELS
+    ], axis=1).astype(np.float64)
+    step = 100.0 / pwm_resolution
+    values = np.round(values / step) * step
+
+    duration = t[-1] - t[0]
+    intervals = np.diff(t)
+    result = {
+        'source': header.get('source'),
+        'updates': int(len(t)),
+        'duration_s': float(duration),
+        'updates_per_s': float((len(t) - 1) / duration) if duration else 0.0,
+        'interval_p50_s': float(np.percentile(intervals, 50)),
+        'interval_p99_s': float(np.percentile(intervals, 99)),
+        'changes': {},
+        'writes': [],
+    }
+    for i, channel in enumerate(CHANNELS):
+        column = values[:, i]
+        column = column[~np.isnan(column)]
+        moves = np.abs(np.diff(column))
+        moves = moves[moves > 0]
+        if not len(moves):
+            continue
+        result['changes'][channel] = {
+            'count': int(len(moves)),
+            'p50': float(np.percentile(moves, 50)),
+            'p90': float(np.percentile(moves, 90)),
+            'p99': float(np.percentile(moves, 99)),
+            'max': float(moves.max()),
+        }
+    for spec in deadbands:
+        deadband = parse_channels(spec)
+        bands = np.array([deadband[k] for k in CHANNELS])
+        for period in periods:
+            writes = simulate_writes(t, values, bands, period)
+            result['writes'].append({
+                'deadband': spec,
+                'period_s': period,
+                'writes': writes,
+                'writes_per_min': writes * 60 / duration if duration else 0.0,
+            })
+    return result
+
+
+def print_analysis(result):
+    print(f'{result["source"]}: {result["updates"]} updates over'
+          f' {result["duration_s"]:.0f}s, {result["updates_per_s"]:.2f}/s,'
+          f' interval p50 {result["interval_p50_s"]:.2f}s'
+          f' p99 {result["interval_p99_s"]:.2f}s')
+    print(f'{"channel":10}{"changes":>9}{"p50":>9}{"p90":>9}{"p99":>9}'
+          f'{"max":>9}')
+    for channel, c in result['changes'].items():
+        print(f'{channel:10}{c["count"]:9}{c["p50"]:9.3f}{c["p90"]:9.3f}'
+              f'{c["p99"]:9.3f}{c["max"]:9.3f}')
+    print(f'{"deadband":20}{"period":>8}{"writes":>9}{"per min":>9}')
+    for w in result['writes']:
+        print(f'{w["deadband"]:20}{w["period_s"]:8g}{w["writes"]:9}'
+              f'{w["writes_per_min"]:9.2f}')
+
+
+def main():
+    argparser = argparse.ArgumentParser(prog='python -m meter.record')
+    argparser.add_argument('log')
+    argparser.add_argument('--deadband', '-d', nargs='+', default=['0'],
+                           metavar='VALUE',
+                           help=('deadbands to try, each one number or per'
+                                 ' channel, e.g. meter=0.5,red=2'))
+    argparser.add_argument('--period', '-s', nargs='+', type=float,
+                           default=[0.0], metavar='SECONDS',
+                           help='polling periods to try, 0 for as recorded')
+    argparser.add_argument('--pwm-resolution', type=int, default=65535)
+    argparser.add_argument('--json', action='store_true',
+                           help='print the results as JSON')
+    options = argparser.parse_args()
+    if not has_numpy:
+        print('analysis needs numpy: pip install numpy')
+        sys.exit(1)
+
+    result = analyze(options.log, options.deadband, options.period,
+                     options.pwm_resolution)
+    if options.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print_analysis(result)
+
+
+if __name__ == '__main__':
+    main()
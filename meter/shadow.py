@@ -0,0 +1,375 @@
+import json
+import time
+import uuid
+import logging
+import threading
+import http.client
+from urllib.parse import urlsplit, quote
+
+from meter import aws
+
+try:
+    import paho.mqtt.client as mqtt
+    has_paho = True
+except ImportError:
+    has_paho = False
+
+logger = logging.getLogger(__name__)
+
+
+def topic_prefix(thing):
+    return f'$aws/things/{thing}/shadow'
+
+
+class BotoShadow:
+    """Thing shadow get/update over the IoT data plane HTTPS API"""
+
+    def __init__(self, thing, clients=None, endpoint=None):
+        self.thing = thing
+        self.clients = clients or aws.manager()
+        self.endpoint = endpoint
+
+    @property
+    def iot(self):
+        # looked up per call so refreshed credentials are picked up
+        return self.clients.client('iot-data', endpoint_url=self.endpoint)
+
+    def get(self):
+        response = self.iot.get_thing_shadow(thingName=self.thing)
+        return json.load(response['payload'])
+
+    def update(self, desired):
+        response = self.iot.update_thing_shadow(
+            thingName=self.thing,
+            payload=json.dumps({'state': {'desired': desired}}).encode()
+        )
+        return json.load(response['payload'])
+
+    def close(self):
+        pass
+
+
+class SigV4Shadow:
+    """Thing shadow get/update with SigV4-signed requests
+
+    A lighter alternative to BotoShadow: no iot-data client is built,
+    requests are signed with botocore's signer and sent over one
+    keep-alive HTTPS connection. The endpoint defaults to the regional
+    ATS data endpoint; an http:// URL may be given for local testing.
+
+    """
+    def __init__(self, thing, clients=None, endpoint=None, timeout=10.0):
+        self.thing = thing
+        self.clients = clients or aws.manager()
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.conn = None
+        region = self.clients.boto3_session().region_name or 'us-east-1'
+        self.endpoint = urlsplit(
+            endpoint or f'https://data-ats.iot.{region}.amazonaws.com'
+        )
+        host = self.endpoint.hostname
+        if host.endswith('.amazonaws.com'):
+            region = host.split('.')[-3]
+        self.region = region
+        self.path = f'/things/{quote(thing, safe="")}/shadow'
+
+    def connect(self):
+        if self.endpoint.scheme == 'http':
+            return http.client.HTTPConnection(
+                self.endpoint.hostname, self.endpoint.port or 80,
+                timeout=self.timeout
+            )
+        return http.client.HTTPSConnection(
+            self.endpoint.hostname, self.endpoint.port or 443,
+            timeout=self.timeout
+        )
+
+    def request(self, method, body=None):
+        from botocore.auth import SigV4Auth
+        from botocore.awsrequest import AWSRequest
+
+        url = f'{self.endpoint.scheme}://{self.endpoint.netloc}{self.path}'
+        request = AWSRequest(method=method, url=url, data=body)
+        if body is not None:
+            request.headers['Content-Type'] = 'application/json'
+        credentials = self.clients.boto3_session().get_credentials()
+        SigV4Auth(credentials.get_frozen_credentials(), 'iotdata',
+                  self.region).add_auth(request)
+        headers = dict(request.headers.items())
+
+        with self.lock:
+            for attempt in (0, 1):
+                if self.conn is None:
+                    self.conn = self.connect()
+                try:
+                    self.conn.request(method, self.path, body, headers)
+                    response = self.conn.getresponse()
+                    payload = response.read()
+                    break
+                except (http.client.HTTPException, OSError):
+                    # the server closed the idle connection; retry once
+                    self.conn.close()
+                    self.conn = None
+                    if attempt:
+                        raise
+        if response.status >= 300:
+            raise Exception(f'{method} {self.path}: {response.status}'
+                            f' {payload[:200]!r}')
+        return json.loads(payload)
+
+    def get(self):
+        return self.request('GET')
+
+    def update(self, desired):
+        return self.request(
+            'POST', json.dumps({'state': {'desired': desired}}).encode()
+        )
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+
+class ShadowMirror:
+    """Latest shadow document of one Thing, as pushed over MQTT"""
+
+    def __init__(self, thing):
+        self.thing = thing
+        self.prefix = topic_prefix(thing)
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.document = None
+        self.received = None
+
+    def store(self, document):
+        document = {
+            'state': document.get('state', {}),
+            'metadata': document.get('metadata', {}),
+            'version': document.get('version'),
+        }
+        with self.lock:
+            self.document = document
+            self.received = time.time()
+        self.ready.set()
+
+    def snapshot(self):
+        """Return the latest document (not to be modified) or None"""
+        with self.lock:
+            return self.document
+
+    def get(self, timeout):
+        if not self.ready.wait(timeout):
+            raise TimeoutError(f'no shadow document for {self.thing}')
+        with self.lock:
+            return json.loads(json.dumps(self.document))
+
+
+class MqttShadow:
+    """Thing shadow get/update over one long-lived MQTT connection
+
+    The shadow document is kept up to date from the `update/documents`
+    and `get/accepted` topics, so `get()` is a local read. Other Things'
+    shadows can be followed over the same connection with follow().
+    The endpoint is a URL:
+
+      mqtt://host[:port]   plain TCP, e.g. a local Mosquitto broker
+      mqtts://host[:port]  TLS without client certificate
+      wss://host           AWS IoT websockets, signed with SigV4
+
+    A bare hostname is treated as `wss://`. If no endpoint is given,
+    the account's ATS data endpoint is looked up. Credentials come from
+    the given ClientManager and are read again on every reconnect.
+
+    """
+    def __init__(self, thing, endpoint=None, clients=None, timeout=10.0):
+        if not has_paho:
+            raise Exception("paho-mqtt module not installed!")
+
+        self.thing = thing
+        self.prefix = topic_prefix(thing)
+        self.timeout = timeout
+        self.clients = clients or aws.manager()
+        self.lock = threading.Lock()
+        self.mirror = ShadowMirror(thing)
+        # topic prefix -> ShadowMirror
+        self.mirrors = {self.prefix: self.mirror}
+        self.connected = False
+        self.last_publish = None
+
+        if endpoint is None:
+            endpoint = self._describe_endpoint()
+        if '://' not in endpoint:
+            endpoint = 'wss://' + endpoint
+        self.endpoint = urlsplit(endpoint)
+        scheme = self.endpoint.scheme
+        if scheme not in ('mqtt', 'mqtts', 'wss'):
+            raise ValueError(f'unsupported MQTT endpoint scheme: {scheme}')
+
+        self.client = self._new_client(
+            f'meter-{thing}-{uuid.uuid4().hex[:8]}',
+            'websockets' if scheme == 'wss' else 'tcp',
+        )
+        if scheme in ('mqtts', 'wss'):
+            self.client.tls_set()
+        if scheme == 'wss':
+            self._sign_websocket()
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.client.on_message = self._on_message
+        self.client.reconnect_delay_set(min_delay=1, max_delay=60)
+
+        port = self.endpoint.port or {
+            'mqtt': 1883, 'mqtts': 8883, 'wss': 443
+        }[scheme]
+        logger.info(f'Connecting to {scheme}://{self.endpoint.hostname}:{port}')
+        self.client.connect_async(self.endpoint.hostname, port, keepalive=60)
+        self.client.loop_start()
+
+    @staticmethod
+    def _new_client(client_id, transport):
+        if hasattr(mqtt, 'CallbackAPIVersion'):
+            # paho-mqtt >= 2.0
+            return mqtt.Client(mqtt.CallbackAPIVersion.VERSION1,
+                               client_id=client_id, transport=transport)
+        return mqtt.Client(client_id=client_id, transport=transport)
+
+    def _describe_endpoint(self):
+        iot = self.clients.client('iot')
+        response = iot.describe_endpoint(endpointType='iot:Data-ATS')
+        return response['endpointAddress']
+
+    def _sign_websocket(self):
+        from botocore.auth import SigV4QueryAuth
+        from botocore.awsrequest import AWSRequest
+        from botocore.credentials import Credentials
+
+        session = self.clients.boto3_session()
+        frozen = session.get_credentials().get_frozen_credentials()
+        region = session.region_name or self.endpoint.hostname.split('.')[2]
+        # AWS IoT expects the session token to be appended after
+        # signing rather than included in the signature
+        request = AWSRequest(
+            method='GET', url=f'https://{self.endpoint.hostname}/mqtt'
+        )
+        SigV4QueryAuth(
+            Credentials(frozen.access_key, frozen.secret_key),
+            'iotdevicegateway', region, expires=3600,
+        ).add_auth(request)
+        path = request.url.split(self.endpoint.hostname, 1)[1]
+        if frozen.token:
+            path += '&X-Amz-Security-Token=' + quote(frozen.token, safe='')
+        self.client.ws_set_options(path=path)
+
+    def _on_connect(self, client, userdata, flags, rc):
+        if rc != 0:
+            logger.warning(f'MQTT connect failed: {mqtt.connack_string(rc)}')
+            return
+        logger.info('MQTT connected')
+        with self.lock:
+            self.connected = True
+            prefixes = list(self.mirrors)
+        for prefix in prefixes:
+            self._subscribe(prefix)
+
+    def _subscribe(self, prefix):
+        self.client.subscribe([
+            (f'{prefix}/update/documents', 1),
+            (f'{prefix}/update/rejected', 1),
+            (f'{prefix}/get/accepted', 1),
+            (f'{prefix}/get/rejected', 1),
+        ])
+        self.client.publish(f'{prefix}/get', b'{}', qos=1)
+
+    def _on_disconnect(self, client, userdata, rc):
+        with self.lock:
+            self.connected = False
+        if rc == 0:
+            return
+        logger.warning(f'MQTT disconnected ({rc}), reconnecting')
+        if self.endpoint.scheme == 'wss':
+            # presigned URLs expire, so sign again before reconnecting
+            self._sign_websocket()
+
+    def _on_message(self, client, userdata, msg):
+        payload = json.loads(msg.payload)
+        prefix = '/'.join(msg.topic.split('/')[:4])
+        mirror = self.mirrors.get(prefix)
+        if mirror is None:
+            return
+        if msg.topic.endswith('/update/documents'):
+            mirror.store(payload['current'])
+        elif msg.topic.endswith('/get/accepted'):
+            mirror.store(payload)
+        else:
+            logger.warning(f'{msg.topic}: {payload}')
+
+    def follow(self, thing):
+        """Return a ShadowMirror of another Thing on this connection"""
+        prefix = topic_prefix(thing)
+        with self.lock:
+            if prefix in self.mirrors:
+                return self.mirrors[prefix]
+            mirror = self.mirrors[prefix] = ShadowMirror(thing)
+            connected = self.connected
+        if connected:
+            # otherwise _on_connect subscribes
+            self._subscribe(prefix)
+        return mirror
+
+    def shadow(self, thing):
+        """Return get/update for another Thing over this connection"""
+        return MqttThingShadow(self, thing)
+
+    def get(self):
+        return self.mirror.get(self.timeout)
+
+    def publish(self, prefix, desired):
+        # the new state arrives asynchronously on update/documents
+        self.last_publish = self.client.publish(
+            f'{prefix}/update',
+            json.dumps({'state': {'desired': desired}}).encode(),
+            qos=1
+        )
+        return self.last_publish
+
+    def update(self, desired):
+        self.publish(self.prefix, desired)
+        return None
+
+    def close(self):
+        if self.last_publish is not None:
+            self.last_publish.wait_for_publish(self.timeout)
+        self.client.disconnect()
+        self.client.loop_stop()
+
+
+class MqttThingShadow:
+    """One Thing's shadow on a shared MqttShadow connection
+
+    Used by Fleet so that all its meters share one MQTT connection.
+    close() leaves the connection open for the others.
+
+    """
+    def __init__(self, connection, thing):
+        self.connection = connection
+        self.thing = thing
+        self.prefix = topic_prefix(thing)
+        self.mirror = connection.follow(thing)
+        self.last_publish = None
+
+    def follow(self, thing):
+        return self.connection.follow(thing)
+
+    def get(self):
+        return self.mirror.get(self.connection.timeout)
+
+    def update(self, desired):
+        self.last_publish = self.connection.publish(self.prefix, desired)
+        return None
+
+    def close(self):
+        if self.last_publish is not None:
+            self.last_publish.wait_for_publish(self.connection.timeout)
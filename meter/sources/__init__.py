@@ -1,11 +1,37 @@
-from meter.sources.inside_temp import InsideTemp
-from meter.sources.weather import OutsideTemp
-from meter.sources.octoprint import OctoPrint
-from meter.sources.aws_stepfunctions import SfnMapRun
-from meter.sources.aws_cloudwatch import CloudWatchAlarm, CloudWatchLogs
-from meter.sources.timers import Pomodoro, CountdownTimer
-from meter.sources.meetings import Meetings
-from meter.sources.traeger import Traeger
-from meter.sources.apcupsd import ApcUps
-from meter.sources.acheater import ACHeater
-from meter.sources.kia_connect import KiaConnect
+import importlib
+
+# source name -> module, imported only when the source is used
+SOURCES = {
+    'InsideTemp': 'meter.sources.inside_temp',
+    'OutsideTemp': 'meter.sources.weather',
+    'OctoPrint': 'meter.sources.octoprint',
+    'SfnMapRun': 'meter.sources.aws_stepfunctions',
+    'CloudWatchAlarm': 'meter.sources.aws_cloudwatch',
+    'CloudWatchLogs': 'meter.sources.aws_cloudwatch',
+    'CloudWatchMetrics': 'meter.sources.aws_cloudwatch',
+    'CloudWatchInsights': 'meter.sources.aws_cloudwatch',
+    'Pomodoro': 'meter.sources.timers',
+    'CountdownTimer': 'meter.sources.timers',
+    'Meetings': 'meter.sources.meetings',
+    'Traeger': 'meter.sources.traeger',
+    'ApcUps': 'meter.sources.apcupsd',
+    'ACHeater': 'meter.sources.acheater',
+    'KiaConnect': 'meter.sources.kia_connect',
+    'Composite': 'meter.sources.composite',
+}
+
+
+def get_source(name):
+    try:
+        module = SOURCES[name]
+    except KeyError:
+        raise AttributeError(f'no source named {name}') from None
+    return getattr(importlib.import_module(module), name)
+
+
+def __getattr__(name):
+    return get_source(name)
+
+
+def __dir__():
+    return sorted(list(globals()) + list(SOURCES))
@@ -1,12 +1,10 @@
 import json
 import time
-import boto3
 
-from meter import config
+from meter import aws
+from meter.shadow import MqttShadow, has_paho
 from meter.sources.base import BaseSource
 
-iot = boto3.client('iot-data')
-
 
 class ACHeater(BaseSource):
     """AC Heater
@@ -15,14 +13,75 @@ class ACHeater(BaseSource):
     enabled, the blue light will illuminate. When the heat is on, the
     red light will illuminate.
 
+    The heater's shadow is pushed over MQTT rather than read every
+    cycle: on the meter's own connection with --transport mqtt, or
+    else on one opened with the meter's credentials. Without paho-mqtt,
+    or if no document is pushed within 10 seconds, the shadow is read
+    each cycle instead. The red light shows when the heater has not
+    reported a new counter for --stale-after seconds.
+
     """
+    USES_REPORTED = False
     OPTIONS = [
-        (['--thing-name'], {"default": "ac-heater"})
+        (['--thing-name'], {"default": "ac-heater"}),
+        (['--stale-after'], {'type': float, 'default': 120.0,
+                             'metavar': 'SECONDS',
+                             'help': 'show red after this long without'
+                                     ' a heartbeat'}),
     ]
+    PUSH_TIMEOUT = 10.0
+
+    def init(self):
+        # until bound to a meter, the shadow is read each cycle
+        self.clients = aws.manager()
+        self.heater = None
+        self.connection = None
+        self.last_tick = None
+        self.last_tick_time = time.time()
+
+    def bind(self, meter):
+        self.clients = meter.clients
+        self.close()
+        try:
+            if hasattr(meter.shadow, 'follow'):
+                # MQTT transport: share the meter's connection
+                self.heater = meter.shadow.follow(self.opts.thing_name)
+            elif has_paho:
+                self.connection = MqttShadow(
+                    self.opts.thing_name, endpoint=meter.mqtt_endpoint,
+                    clients=meter.clients
+                )
+                self.heater = self.connection.mirror
+        except Exception:
+            # e.g. a role without the iot:Connect or DescribeEndpoint
+            # permissions; GetThingShadow may still be allowed
+            self.logger.warning(f'{self.opts.thing_name}: MQTT setup failed',
+                                exc_info=True)
+            self.close()
+        if self.heater is not None and \
+           not self.heater.ready.wait(self.PUSH_TIMEOUT):
+            self.logger.warning(f'{self.opts.thing_name}: no shadow pushed'
+                                f' in {self.PUSH_TIMEOUT:.0f}s')
+            self.close()
+        self.log(f'{self.opts.thing_name}: '
+                 f'{"push" if self.heater else "polling"}')
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+        self.connection = None
+        self.heater = None
+
+    def status(self):
+        if self.heater is not None:
+            return self.heater.snapshot()
+        response = self.clients.client('iot-data').get_thing_shadow(
+            thingName=self.opts.thing_name
+        )
+        return json.load(response['payload'])
 
     def update(self, reported):
-        response = iot.get_thing_shadow(thingName=self.opts.thing_name)
-        status = json.load(response['payload'])
+        status = self.status()
         reported = status['state']['reported']
 
         if reported['current_t'] < reported['current_set_t']:
@@ -36,14 +95,18 @@ class ACHeater(BaseSource):
                 0.25 * (reported['current_t'] - reported['current_set_t']) * 80
             )
 
-        if not hasattr(self, 'last_tick') or reported['counter'] != self.last_tick:
+        if reported['counter'] != self.last_tick:
             self.last_tick = reported['counter']
-            self.last_tick_time = time.time()
+            # when the heater reported it, rather than when we saw it
+            stamp = status.get('metadata', {}).get('reported', {}) \
+                .get('counter', {}).get('timestamp')
+            self.last_tick_time = stamp or time.time()
             self.log(f"current_t: {reported['current_t']} meter: {meter}")
-        
+
+        stale = time.time() - self.last_tick_time > self.opts.stale_after
         return {
             'meter': meter,
-            'red': 50 if (time.time() - self.last_tick_time) > 120 else 0,
-            'green': 20 if status['state']['reported']['heat_cmd'] == 'on' else 0,
-            'blue': 5 if status['state']['reported']['enable'] else 0,
+            'red': 50 if stale else 0,
+            'green': 20 if reported['heat_cmd'] == 'on' else 0,
+            'blue': 5 if reported['enable'] else 0,
         }
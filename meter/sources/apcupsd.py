@@ -1,31 +1,116 @@
-try:
-    from apcaccess import status as apc
-except ImportError:
-    apc = None
+import time
+import socket
+import struct
+import logging
 
 from meter.sources.base import BaseSource
 
+logger = logging.getLogger(__name__)
+
+
+class NISClient:
+    """apcupsd Network Information Server client
+
+    Keeps one connection open across requests. Each request is a
+    length-prefixed command; the reply is a series of length-prefixed
+    records ending with an empty one. After a connection failure,
+    reconnects are spaced out with an exponential backoff.
+
+    """
+    def __init__(self, host, port=3551, timeout=10.0, max_backoff=60.0):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.max_backoff = max_backoff
+        self.sock = None
+        self.rfile = None
+        self.failures = 0
+        self.retry_at = 0.0
+
+    def connect(self):
+        now = time.monotonic()
+        if now < self.retry_at:
+            raise ConnectionError(f'{self.host}:{self.port} unreachable,'
+                                  f' retrying in {self.retry_at - now:.0f}s')
+        try:
+            self.sock = socket.create_connection((self.host, self.port),
+                                                 timeout=self.timeout)
+        except OSError:
+            self.failures += 1
+            self.retry_at = now + min(self.max_backoff, 2 ** self.failures)
+            raise
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.rfile = self.sock.makefile('rb')
+        self.failures = 0
+
+    def close(self):
+        if self.sock is not None:
+            self.rfile.close()
+            self.sock.close()
+            self.sock = self.rfile = None
+
+    def read_exact(self, n):
+        data = self.rfile.read(n)
+        if len(data) < n:
+            raise ConnectionError('NIS connection closed')
+        return data
+
+    def records(self, command):
+        self.sock.sendall(struct.pack('!H', len(command)) + command)
+        while True:
+            length = struct.unpack('!H', self.read_exact(2))[0]
+            if not length:
+                return
+            yield self.read_exact(length)
+
+    def request(self, command, keys):
+        """Return {key: value} for the requested keys only"""
+        prefixes = tuple(k.encode() for k in keys)
+        for attempt in (0, 1):
+            reused = self.sock is not None
+            if not reused:
+                self.connect()
+            try:
+                values = {}
+                for record in self.records(command):
+                    if record.startswith(prefixes):
+                        key, _, value = record.partition(b':')
+                        values[key.strip().decode()] = value.strip().decode()
+                return values
+            except OSError:
+                self.close()
+                # the server may have dropped the idle connection
+                if not reused or attempt:
+                    raise
+
+    def status(self, keys):
+        return self.request(b'status', keys)
+
 
 class ApcUps(BaseSource):
     """APC UPS current battery level
 
-    To use this, ensure that the `apcaccess` Python module is installed:
-
-        pip install apcaccess
+    Reads the status from apcupsd's Network Information Server (NIS)
+    on --hostname, over one connection kept open between cycles.
 
     """
+    USES_REPORTED = False
     OPTIONS = [
         (['--hostname'], {"required": True}),
+        (['--port'], {'type': int, 'default': 3551}),
     ]
 
+    def init(self):
+        self.nis = NISClient(self.opts.hostname, self.opts.port)
+
     def update(self, reported):
-        if apc is None:
-            return {}
-        
-        result = apc.parse(apc.get(host=self.opts.hostname), strip_units=True)
+        result = self.nis.status(['BCHARGE', 'STATUS'])
+        # e.g. "BCHARGE  : 100.0 Percent" and "STATUS   : ONLINE"
+        charge = float(result['BCHARGE'].split()[0])
+        status = result['STATUS']
 
         return {
-            'meter': float(result['BCHARGE']),
-            'red': 25 if 'ONBATT' in result['STATUS'] else 0,
-            'green': 25 if 'ONLINE' in result['STATUS'] else 0
+            'meter': charge,
+            'red': 25 if 'ONBATT' in status else 0,
+            'green': 25 if 'ONLINE' in status else 0
         }
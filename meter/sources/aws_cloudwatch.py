@@ -1,13 +1,14 @@
 import re
 import time
-from datetime import datetime, timedelta
-import boto3
+from datetime import datetime, timedelta, timezone
 
 from meter import config
+from meter.aws import client
 from meter.sources.base import BaseSource
 
-cw = boto3.client('cloudwatch')
-logs = boto3.client('logs')
+# numbered backreferences and conditionals, which would point at another
+# expression's groups once the expressions are joined
+BACKREFERENCE = re.compile(r'\\[1-9]|\(\?\(')
 
 
 def find_key(k, d):
@@ -21,7 +22,23 @@ def find_key(k, d):
                 yield d[i]
             elif isinstance(d[i], (dict, list)):
                 yield from find_key(k, d[i])
-            
+
+
+def next_period(period, delay=3.0):
+    # a new datapoint is available shortly after each period ends
+    now = time.time()
+    return now - (now % period) + period + delay
+
+
+def period_index(period):
+    """Number of the current period since the epoch
+
+    Cached alarm state is kept for as long as this stays the same, and
+    next_period() wakes up just after it changes.
+
+    """
+    return int(time.time() // period)
+
 
 class CloudWatchAlarm(BaseSource):
     """CloudWatch Alarm status
@@ -30,47 +47,280 @@ class CloudWatchAlarm(BaseSource):
     in state ALARM, the red light will illuminate.
 
     """
+    USES_REPORTED = False
     OPTIONS = [
         (['name'], {"config_save": False, 'help': 'CloudWatch alarm name'}),
         (['--composite', '-c'], {"action": "store", "type": config.to_bool,
                                  'help': 'alarm type is composite'}),
+        (['--alarm-ttl'], {'type': float, 'metavar': 'SECONDS',
+                           'help': ('re-read the alarm state this often;'
+                                    ' defaults to the metric period')}),
     ]
 
-    def update(self, reported):
+    def init(self):
+        self.alarm = None
+        self.alarm_period = None
+        self.configured = None
+        self.last_timestamp = None
+        self.value = None
+
+    def describe(self):
         alarm_type = 'CompositeAlarm' if self.opts.composite else 'MetricAlarm'
-        response = cw.describe_alarms(
+        response = client('cloudwatch').describe_alarms(
             AlarmNames=[self.opts.name],
             AlarmTypes=[alarm_type],
         )
-        alarm = response[alarm_type + 's'][0]
-        metric_data_q = alarm['Metrics']
-        period = max(find_key('Period', metric_data_q))
-
-        # align to period by waiting
-        have_updated = getattr(self, 'have_updated', False)
-        ahead_of_period = datetime.now().timestamp() % period
-        if ahead_of_period > self.min_cycle and have_updated:
-            time_to_next_period = period - ahead_of_period
-            time_to_wait = time_to_next_period + 3.0
-            dest = datetime.now() + timedelta(seconds=time_to_wait)
-            self.log(f'waiting {int(time_to_wait)} seconds until {dest}')
-            time.sleep(time_to_wait)
-        
-        response = cw.get_metric_data(
-            MetricDataQueries=metric_data_q,
-            StartTime=datetime.now() - timedelta(seconds=period),
-            EndTime=datetime.now()
+        self.alarm = response[alarm_type + 's'][0]
+        configured = self.alarm.get('AlarmConfigurationUpdatedTimestamp')
+        if configured != self.configured or self.configured is None:
+            # definition changed, so derive the queries again and start
+            # a fresh datapoint window
+            self.configured = configured
+            self.metric_data_q = self.alarm['Metrics']
+            self.period = max(find_key('Period', self.metric_data_q))
+            self.last_timestamp = None
+            self.log(f'{self.opts.name}: period {self.period}s')
+        self.alarm_period = period_index(self.alarm_ttl())
+
+    def alarm_ttl(self):
+        return self.opts.alarm_ttl or self.period
+
+    def update(self, reported):
+        # wakeups within the same period reuse the cached state
+        if self.alarm is None or \
+           period_index(self.alarm_ttl()) != self.alarm_period:
+            self.describe()
+        alarm = self.alarm
+
+        # only ask for datapoints from the newest one seen (which may
+        # still be filling in) onwards
+        now = datetime.now(timezone.utc)
+        start = now - timedelta(seconds=self.period)
+        if self.last_timestamp is not None:
+            start = max(start, self.last_timestamp)
+        response = client('cloudwatch').get_metric_data(
+            MetricDataQueries=self.metric_data_q,
+            StartTime=start,
+            EndTime=now,
+            ScanBy='TimestampDescending',
         )
-        values = response['MetricDataResults'][0]['Values']
-        value = values[-1]
+        result = response['MetricDataResults'][0]
+        if result['Values']:
+            self.value = result['Values'][0]
+            self.last_timestamp = result['Timestamps'][0]
+        value = self.value
         self.log(f'{self.opts.name}: {alarm["StateValue"]} {value}')
-        self.have_updated = True
-        return {
-            'meter': value,
+        state = {
             'red': 50 if alarm['StateValue'] == 'ALARM' else 0,
             'green': 0,
             'blue': 0,
         }
+        if value is not None:
+            state['meter'] = value
+        return state
+
+    def next_update(self, step):
+        # just after the next datapoint or alarm state refresh is due
+        return min(next_period(self.period), next_period(self.alarm_ttl()))
+
+
+STATE_RANK = {'OK': 0, 'INSUFFICIENT_DATA': 1, 'ALARM': 2}
+
+
+class CloudWatchMetrics(BaseSource):
+    """Aggregate of many CloudWatch metrics and alarms
+
+    Every metric, and the metrics behind every alarm, is fetched in a
+    single GetMetricData request and combined server-side with a
+    metric math expression (--aggregate); the meter shows the result.
+    The red light illuminates when any alarm is in state ALARM, the
+    blue light when the worst state is INSUFFICIENT_DATA.
+
+    Metrics are given as NAMESPACE,METRIC[,DIMENSION=VALUE...], e.g.
+
+        --metric AWS/SQS,ApproximateNumberOfMessagesVisible,QueueName=jobs
+
+    """
+    USES_REPORTED = False
+    OPTIONS = [
+        (['--metric', '-M'], {'action': 'append', 'default': [],
+                              'config_save': False, 'metavar': 'SPEC',
+                              'help': 'metric to include, may be repeated'}),
+        (['--alarm', '-A'], {'action': 'append', 'default': [],
+                             'config_save': False, 'metavar': 'NAME',
+                             'help': 'alarm to include, may be repeated'}),
+        (['--stat'], {'default': 'Average',
+                      'help': 'statistic for --metric metrics'}),
+        (['--metric-period'], {'type': int, 'default': 60,
+                               'metavar': 'SECONDS',
+                               'help': 'period for --metric metrics'}),
+        (['--aggregate'], {'choices': ['max', 'min', 'sum', 'avg'],
+                           'default': 'max'}),
+        (['--max-value', '-m'],
+         {'type': float, 'config_save': False,
+          'help': ('if provided, the aggregate will be divided by'
+                   ' this fixed value')}),
+    ]
+    MAX_QUERIES = 500
+
+    def init(self):
+        if not self.opts.metric and not self.opts.alarm:
+            raise Exception("provide at least one --metric or --alarm")
+        self.alarms = []
+        self.alarms_period = None
+        self.configured = None
+        self.queries = None
+        self.value = None
+
+    def describe(self):
+        alarms = []
+        names = self.opts.alarm
+        for i in range(0, len(names), 100):
+            kwargs = {
+                'AlarmNames': names[i:i + 100],
+                'AlarmTypes': ['MetricAlarm', 'CompositeAlarm'],
+            }
+            while True:
+                response = client('cloudwatch').describe_alarms(**kwargs)
+                alarms += response['MetricAlarms']
+                alarms += response['CompositeAlarms']
+                if not response.get('NextToken'):
+                    break
+                kwargs['NextToken'] = response['NextToken']
+        self.alarms = alarms
+        configured = [a.get('AlarmConfigurationUpdatedTimestamp')
+                      for a in alarms]
+        if self.queries is None or configured != self.configured:
+            self.configured = configured
+            self.queries = self.build_queries()
+            self.log(f'{len(self.queries)} metric data queries')
+        self.alarms_period = period_index(self.period)
+
+    def build_queries(self):
+        queries = []
+        returned = []
+        for i, spec in enumerate(self.opts.metric):
+            namespace, name, *dims = spec.split(',')
+            queries.append({
+                'Id': f'm{i}',
+                'MetricStat': {
+                    'Metric': {
+                        'Namespace': namespace,
+                        'MetricName': name,
+                        'Dimensions': [
+                            {'Name': k, 'Value': v}
+                            for k, v in (d.split('=', 1) for d in dims)
+                        ],
+                    },
+                    'Period': self.opts.metric_period,
+                    'Stat': self.opts.stat,
+                },
+                'ReturnData': False,
+            })
+            returned.append(f'm{i}')
+
+        periods = [self.opts.metric_period] if self.opts.metric else []
+        for i, alarm in enumerate(self.alarms):
+            if 'Metrics' in alarm:
+                # metric math alarm: give its query ids a unique prefix
+                prefix = f'a{i}_'
+                ids = re.compile(r'\b(%s)\b' % '|'.join(
+                    re.escape(q['Id']) for q in alarm['Metrics']
+                ))
+                for q in alarm['Metrics']:
+                    if q.get('ReturnData', True):
+                        # this is the series the alarm evaluates
+                        returned.append(prefix + q['Id'])
+                    q = dict(q, Id=prefix + q['Id'], ReturnData=False)
+                    if 'Expression' in q:
+                        q['Expression'] = ids.sub(
+                            lambda m: prefix + m.group(1), q['Expression']
+                        )
+                    queries.append(q)
+                periods += list(find_key('Period', alarm['Metrics']))
+            elif 'MetricName' in alarm:
+                queries.append({
+                    'Id': f'a{i}',
+                    'MetricStat': {
+                        'Metric': {
+                            'Namespace': alarm['Namespace'],
+                            'MetricName': alarm['MetricName'],
+                            'Dimensions': alarm.get('Dimensions', []),
+                        },
+                        'Period': alarm['Period'],
+                        'Stat': (alarm.get('Statistic')
+                                 or alarm.get('ExtendedStatistic')),
+                    },
+                    'ReturnData': False,
+                })
+                returned.append(f'a{i}')
+                periods.append(alarm['Period'])
+
+        self.period = max(periods or [60])
+        if returned:
+            queries.append({
+                'Id': 'aggregate',
+                'Expression': (f'{self.opts.aggregate.upper()}'
+                               f'([{", ".join(returned)}])'),
+                'Period': self.period,
+                'ReturnData': True,
+            })
+        if len(queries) > self.MAX_QUERIES:
+            raise Exception(f'{len(queries)} queries, GetMetricData'
+                            f' accepts at most {self.MAX_QUERIES}')
+        return queries
+
+    def fetch(self):
+        now = datetime.now(timezone.utc)
+        kwargs = {
+            'MetricDataQueries': self.queries,
+            'StartTime': now - timedelta(seconds=self.period * 3),
+            'EndTime': now,
+            'ScanBy': 'TimestampDescending',
+        }
+        values = []
+        while True:
+            response = client('cloudwatch').get_metric_data(**kwargs)
+            for result in response['MetricDataResults']:
+                if result['Id'] == 'aggregate':
+                    values += result['Values']
+            if not response.get('NextToken'):
+                break
+            kwargs['NextToken'] = response['NextToken']
+        return values
+
+    def update(self, reported):
+        if self.queries is None or (
+            self.opts.alarm
+            and period_index(self.period) != self.alarms_period
+        ):
+            if self.opts.alarm:
+                self.describe()
+            else:
+                self.queries = self.build_queries()
+
+        if self.queries:
+            values = self.fetch()
+            if values:
+                self.value = values[0]
+                if self.opts.max_value:
+                    self.value = (self.value / self.opts.max_value) * 100.0
+
+        worst = max([STATE_RANK.get(a['StateValue'], 0) for a in self.alarms]
+                    or [0])
+        self.log(f'{len(self.alarms)} alarms, worst state {worst},'
+                 f' {self.opts.aggregate} {self.value}')
+        state = {
+            'red': 50 if worst == STATE_RANK['ALARM'] else 0,
+            'green': 0,
+            'blue': 25 if worst == STATE_RANK['INSUFFICIENT_DATA'] else 0,
+        }
+        if self.value is not None:
+            state['meter'] = self.value
+        return state
+
+    def next_update(self, step):
+        return next_period(self.period)
 
 
 class CloudWatchLogs(BaseSource):
@@ -84,6 +334,10 @@ class CloudWatchLogs(BaseSource):
     the red, green, or blue regexes will, when matched in the log
     stream, cause the respective colored light to illuminate.
 
+    Each cycle reads every new event, so a busy stream never falls
+    behind; only the newest match per channel is used. With
+    --filter-pattern, events are filtered server-side first.
+
     """
     OPTIONS = [
         (['log_group_name'], {'config_save': False}),
@@ -96,51 +350,129 @@ class CloudWatchLogs(BaseSource):
         (['--red-regex', '-R'], {}),
         (['--green-regex', '-G'], {}),
         (['--blue-regex', '-B'], {}),
+        (['--filter-pattern', '-F'],
+         {'config_save': False,
+          'help': ('CloudWatch Logs filter pattern, applied server-side'
+                   ' before the regular expressions')}),
     ]
+    # bound the time spent catching up in a single cycle
+    MAX_PAGES = 50
 
-    def update(self, reported):
-        next_token = getattr(self, 'next_token', None)
+    def init(self):
+        self.regexps = {
+            'meter': re.compile(self.opts.regex)
+        }
+        if self.opts.red_regex:
+            self.regexps['red'] = re.compile(self.opts.red_regex)
+        if self.opts.green_regex:
+            self.regexps['green'] = re.compile(self.opts.green_regex)
+        if self.opts.blue_regex:
+            self.regexps['blue'] = re.compile(self.opts.blue_regex)
+        # prefilter: one search skips messages no channel matches;
+        # messages that pass are still searched per channel
+        self.matcher = None
+        if not any(BACKREFERENCE.search(r.pattern)
+                   for r in self.regexps.values()):
+            try:
+                self.matcher = re.compile('|'.join(
+                    f'(?:{r.pattern})' for r in self.regexps.values()
+                ))
+            except re.error:
+                # e.g. the same group name used in two expressions
+                pass
+        self.next_token = None
+        self.window_end = None
+
+    def get_events(self):
         kwargs = {
             'logGroupName': self.opts.log_group_name,
             'logStreamName': self.opts.log_stream_name,
-            'limit': 10,
         }
-        if next_token:
+        if self.next_token:
             kwargs['startFromHead'] = True
-            kwargs['nextToken'] = next_token
+            kwargs['nextToken'] = self.next_token
         else:
             kwargs['startFromHead'] = False
+            kwargs['limit'] = 10
+
+        events = []
+        for _ in range(self.MAX_PAGES):
+            response = client('logs').get_log_events(**kwargs)
+            events += response['events']
+            token = response['nextForwardToken']
+            # the same token comes back once the end of the stream is reached
+            caught_up = (token == kwargs.get('nextToken')
+                         or not response['events'])
+            self.next_token = token
+            if caught_up:
+                break
+            kwargs.pop('limit', None)
+            kwargs['startFromHead'] = True
+            kwargs['nextToken'] = token
+        return events
+
+    def filter_events(self):
+        kwargs = {
+            'logGroupName': self.opts.log_group_name,
+            'logStreamNames': [self.opts.log_stream_name],
+            'filterPattern': self.opts.filter_pattern,
+        }
+        now = int(time.time() * 1000)
+        # continue from the end of the last window, however long ago
+        # (backoff, idle cycles) that was
+        if self.window_end is not None:
+            kwargs['startTime'] = self.window_end + 1
+        else:
+            kwargs['startTime'] = now - int(self.min_cycle * 1000)
+        kwargs['endTime'] = now
 
-        response = logs.get_log_events(**kwargs)
-        self.next_token = response['nextForwardToken']
+        events = []
+        for _ in range(self.MAX_PAGES):
+            response = client('logs').filter_log_events(**kwargs)
+            events += response['events']
+            if not response.get('nextToken'):
+                self.window_end = now
+                break
+            kwargs['nextToken'] = response['nextToken']
+        else:
+            # out of pages: pick up after the last event next cycle
+            if events:
+                self.window_end = max(e['timestamp'] for e in events)
+        events.sort(key=lambda e: e['timestamp'])
+        return events
 
-        # search through the logs with the regex
+    def update(self, reported):
+        if self.opts.filter_pattern:
+            events = self.filter_events()
+        else:
+            events = self.get_events()
+
+        # search through the logs with the regex, newest first
         data = {
             'meter': None,
             'red': 0,
             'green': 0,
             'blue': 0,
         }
-        regexps = {
-            'meter': re.compile(self.opts.regex)
-        }
-        if self.opts.red_regex:
-            regexps['red'] = re.compile(self.opts.red_regex)
-        if self.opts.green_regex:
-            regexps['green'] = re.compile(self.opts.green_regex)
-        if self.opts.blue_regex:
-            regexps['blue'] = re.compile(self.opts.blue_regex)
-        for row in response['events']:
-            for k in regexps:
-                m = regexps[k].search(row['message'])
-                if m is not None:
-                    if k == 'meter':
-                        value = float(m.groups()[0])
-                        self.log(f'{value}: {row["message"].strip()}')
-                        data[k] = value
-                    else:
-                        self.log(f'{k}: {row["message"].strip()}')
-                        data[k] = 50
+        pending = set(self.regexps)
+        for row in reversed(events):
+            if not pending:
+                break
+            message = row['message']
+            if self.matcher is not None and not self.matcher.search(message):
+                continue
+            for k in list(pending):
+                m = self.regexps[k].search(message)
+                if m is None:
+                    continue
+                pending.discard(k)
+                if k == 'meter':
+                    value = float(m.groups()[0])
+                    self.log(f'{value}: {message.strip()}')
+                    data[k] = value
+                else:
+                    self.log(f'{k}: {message.strip()}')
+                    data[k] = 50
 
         if data['meter'] is not None:
             if self.opts.max_value:
@@ -150,3 +482,114 @@ class CloudWatchLogs(BaseSource):
             data['meter'] = reported['meter']
 
         return data
+
+
+class CloudWatchInsights(BaseSource):
+    """CloudWatch Logs Insights query result
+
+    Runs a Logs Insights query, for example
+
+        'stats avg(latency) by bin(1m)'
+
+    every --every seconds over the last --window seconds, and shows a
+    numeric field from the newest result row on the meter. The query
+    runs server-side; each cycle only checks on it, so a slow query
+    never holds up the loop. The red light illuminates if the last
+    query failed.
+
+    """
+    USES_REPORTED = False
+    OPTIONS = [
+        (['query'], {'config_save': False,
+                     'help': 'Logs Insights query string'}),
+        (['--log-group', '-g'], {'action': 'append', 'default': [],
+                                 'config_save': False, 'required': True,
+                                 'help': 'log group, may be repeated'}),
+        (['--field', '-f'], {'config_save': False,
+                             'help': ('result field to show; defaults to the'
+                                      ' first numeric field')}),
+        (['--window'], {'type': int, 'default': 300, 'metavar': 'SECONDS',
+                        'help': 'query over the last SECONDS of logs'}),
+        (['--every'], {'type': int, 'default': 60, 'metavar': 'SECONDS',
+                       'help': 'start a new query this often'}),
+        (['--max-value', '-m'],
+         {'type': float, 'config_save': False,
+          'help': ('if provided, the value will be divided by'
+                   ' this fixed value')}),
+    ]
+
+    def init(self):
+        self.query_id = None
+        self.next_start = 0.0
+        self.value = None
+        self.failed = False
+
+    def start(self):
+        now = int(time.time())
+        response = client('logs').start_query(
+            logGroupNames=self.opts.log_group,
+            startTime=now - self.opts.window,
+            endTime=now,
+            queryString=self.opts.query,
+        )
+        self.query_id = response['queryId']
+        self.next_start = time.time() + self.opts.every
+        self.log(f'started query {self.query_id}')
+
+    def pick(self, results):
+        """Return the value of the chosen field in the newest row"""
+        rows = [
+            {f['field']: f['value'] for f in row if f['field'] != '@ptr'}
+            for row in results
+        ]
+        if not rows:
+            return None
+        bins = [k for k in rows[0] if k.startswith('bin(')]
+        if bins:
+            # timestamps like "2024-01-01 12:34:00.000" sort as strings
+            row = max(rows, key=lambda r: r.get(bins[0], ''))
+        else:
+            row = rows[-1]
+        fields = [self.opts.field] if self.opts.field else [
+            k for k in row if k not in bins
+        ]
+        for k in fields:
+            try:
+                return float(row[k])
+            except (KeyError, ValueError):
+                continue
+        return None
+
+    def update(self, reported):
+        if self.query_id:
+            response = client('logs').get_query_results(queryId=self.query_id)
+            status = response['status']
+            if status == 'Complete':
+                value = self.pick(response['results'])
+                stats = response.get('statistics', {})
+                self.log(f'{value} ({stats.get("recordsScanned")} records'
+                         f' scanned)')
+                if value is not None:
+                    if self.opts.max_value:
+                        value = (value / self.opts.max_value) * 100.0
+                    self.value = value
+                self.query_id = None
+                self.failed = False
+            elif status not in ('Scheduled', 'Running'):
+                self.log(f'query {self.query_id} {status}')
+                self.query_id = None
+                self.failed = True
+
+        if self.query_id is None and time.time() >= self.next_start:
+            self.start()
+
+        state = {'red': 50 if self.failed else 0}
+        if self.value is not None:
+            state['meter'] = self.value
+        return state
+
+    def next_update(self, step):
+        if self.query_id:
+            # still running, check again on the next regular cycle
+            return None
+        return self.next_start
@@ -1,9 +1,6 @@
-import boto3
-
+from meter.aws import client
 from meter.sources.base import BaseSource
 
-sfn = boto3.client('stepfunctions')
-
 
 class SfnMapRun(BaseSource):
     """Step Functions Map Run status
@@ -13,6 +10,7 @@ class SfnMapRun(BaseSource):
     run succeeds; blue light illuminates when the run is aborted.
 
     """
+    USES_REPORTED = False
     OPTIONS = [
         (['arn'], {"config_save": False, 'help': 'Step Functions Map Run ARN'}),
         (['--known-failures'],
@@ -21,7 +19,7 @@ class SfnMapRun(BaseSource):
     ]
 
     def update(self, reported):
-        response = sfn.describe_map_run(
+        response = client('stepfunctions').describe_map_run(
             mapRunArn=self.opts.arn
         )
         num_done = (
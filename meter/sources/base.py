@@ -1,3 +1,4 @@
+import asyncio
 import logging
 import textwrap
 
@@ -6,10 +7,14 @@ from meter import config
 
 class BaseSource:
     OPTIONS = []
+    # set to False when update() ignores the meter's reported state, so
+    # that Meter can skip reading the shadow in write-only mode
+    USES_REPORTED = True
     
-    def __init__(self, options, min_cycle=4.0):
+    def __init__(self, options, min_cycle=4.0, use_config=True):
         argparser = config.DefaultArgumentParser(
             source=self.__class__.__name__,
+            use_config=use_config,
             description=self.description(),
             epilog=self.help_text(),
         )
@@ -21,6 +26,41 @@ class BaseSource:
         if hasattr(self, 'init'):
             self.init()
 
+    def update(self, reported):
+        # sources that only implement aupdate() still work with Meter.loop
+        return asyncio.run(self.aupdate(reported))
+
+    async def aupdate(self, reported, executor=None):
+        """Return the desired state without blocking the event loop
+
+        Override with a native coroutine in new sources; by default the
+        blocking update() runs on the given executor.
+
+        """
+        if type(self).update is BaseSource.update:
+            raise NotImplementedError(
+                f'{self.__class__.__name__} must implement update or aupdate'
+            )
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, self.update, reported)
+
+    def bind(self, meter):
+        """Called with the Meter before its loop starts
+
+        Sources that talk to AWS can share the meter's credentials
+        (meter.clients) and shadow connection from here.
+
+        """
+
+    def next_update(self, step):
+        """Return the time.time() at which the output will next change
+
+        step is the smallest change of the meter value that is worth
+        a new cycle. Return None to leave the timing to the scheduler.
+
+        """
+        return None
+
     def log(self, *args, level=logging.INFO):
         self.logger.log(level, *args) #stacklevel=2 ... py3.8
 
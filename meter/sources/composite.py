@@ -0,0 +1,92 @@
+import shlex
+import threading
+
+from meter import sources
+from meter.iot import Scheduler
+from meter.utils import CHANNELS
+from meter.sources.base import BaseSource
+
+
+class Composite(BaseSource):
+    """Channels driven by different sources
+
+    Give a source command line for each channel to drive, e.g.
+
+        meter Composite --meter 'OctoPrint --hostname octopi.local' \
+                        --red 'CloudWatchAlarm my-alarm' \
+                        --green 'Meetings --calendar Work'
+
+    Each channel takes that channel's value from its source. Every
+    source is polled on its own thread at its own cadence (including
+    backoff and next_update hints), so a slow source never delays the
+    others; each cycle only merges the latest values.
+
+    """
+    OPTIONS = [
+        ([f'--{channel}'], {'metavar': 'SOURCE',
+                            'help': f'source command line for {channel}'})
+        for channel in CHANNELS
+    ]
+
+    def init(self):
+        self.lock = threading.Lock()
+        self.latest = {}
+        self.reported = {}
+        self.step = 1.0
+        self.subsources = {}
+        for channel in CHANNELS:
+            spec = getattr(self.opts, channel)
+            if not spec:
+                continue
+            args = shlex.split(spec)
+            source_type = sources.get_source(args[0])
+            self.subsources[channel] = source_type(
+                args[1:], min_cycle=self.min_cycle
+            )
+        if not self.subsources:
+            raise Exception("provide a source for at least one channel")
+        self.USES_REPORTED = any(
+            s.USES_REPORTED for s in self.subsources.values()
+        )
+        self.started = False
+
+    def start(self):
+        # not before the first update(): sub-sources need the meter's
+        # reported state and bind() to have run
+        self.started = True
+        for channel, source in self.subsources.items():
+            threading.Thread(
+                target=self.poll, args=(channel, source),
+                name=f'{channel}-{source.__class__.__name__}', daemon=True
+            ).start()
+
+    def poll(self, channel, source):
+        scheduler = Scheduler(source.min_cycle)
+        while scheduler.cycle():
+            try:
+                value = source.update(self.reported).get(channel)
+            except Exception:
+                self.logger.exception(f'{channel}: update failed')
+                scheduler.failure()
+                continue
+            with self.lock:
+                changed = value is not None and self.latest.get(channel) != value
+                if value is not None:
+                    self.latest[channel] = value
+            scheduler.success(changed, source.next_update(self.step))
+
+    def update(self, reported):
+        self.reported = reported
+        if not self.started:
+            self.start()
+        with self.lock:
+            return dict(self.latest)
+
+    def bind(self, meter):
+        for source in self.subsources.values():
+            source.bind(meter)
+
+    def next_update(self, step):
+        # passed on to the sub-source schedulers
+        self.step = step
+        return None
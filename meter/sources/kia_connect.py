@@ -11,16 +11,19 @@ from meter.sources.base import BaseSource
 class KiaConnect(BaseSource):
     """EV battery charge data from Hyundai/Kia Connect
     """
+    USES_REPORTED = False
     OPTIONS = [
         (['--username'], {"required": True, "help": "Account username"}),
         (['--password'], {"required": True, "help": "Account password"}),
         (['--pin'], {"default": "", "help": "Account PIN"}),
         (['--brand'], {"required": True,
                        "help": "Car brand",
-                       "choices": sorted(const.BRANDS.values())}),
+                       "choices": (sorted(const.BRANDS.values())
+                                   if has_kia_connect else None)}),
         (['--region'], {"default": "USA",
                         "help": "Region",
-                        "choices": sorted(const.REGIONS.values())}),
+                        "choices": (sorted(const.REGIONS.values())
+                                    if has_kia_connect else None)}),
         (['--vehicle'], {"help": "Vehicle name, if more than one"}),
     ]
 
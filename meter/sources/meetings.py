@@ -1,5 +1,6 @@
 import subprocess
 from datetime import datetime, timedelta
+from meter.ical import Calendar
 from meter.sources.base import BaseSource
 
 
@@ -18,18 +19,41 @@ COMMAND = [
 class Meetings(BaseSource):
     """Meeting countdown timer
 
-    Requires icalBuddy to be installed (https://hasseg.org/icalBuddy/).
+    Reads today's meetings either from macOS Calendar with icalBuddy
+    (https://hasseg.org/icalBuddy/), given --calendar, or on any
+    platform from an .ics file or a directory of them (e.g. a CalDAV
+    export), given --ics. The .ics files are parsed again only when
+    they change.
 
     """
+    USES_REPORTED = False
     OPTIONS = [
-        (['--calendar'], {"required": True, 'help': 'Calendar name'}),
+        (['--calendar'], {'help': 'icalBuddy calendar name'}),
+        (['--ics'], {'metavar': 'PATH',
+                     'help': '.ics file or directory of .ics files'}),
     ]
 
     def init(self):
+        if not self.opts.calendar and not self.opts.ics:
+            raise Exception("provide --calendar or --ics")
         self.last_update = datetime.min
-    
+        self.start = self.end = None
+        self.calendar = Calendar(self.opts.ics) if self.opts.ics else None
+
+    def read_ics(self):
+        now = datetime.now()
+        self.calendar.refresh()
+        self.last_update = now
+        meeting = self.calendar.lookup(now)
+        if meeting is None:
+            self.start = self.end = None
+        else:
+            self.start, self.end, _ = meeting
+
     def update(self, reported):
-        if datetime.now() > self.last_update + timedelta(minutes=1):
+        if self.calendar is not None:
+            self.read_ics()
+        elif datetime.now() > self.last_update + timedelta(minutes=1):
             cmd = [
                 self.opts.calendar if c == '@@CALENDAR@@' else c
                 for c in COMMAND
@@ -61,3 +85,19 @@ class Meetings(BaseSource):
             'green': 50 if value and position < 90 else 0,
             'red': 50 if value < 2 and value > 0 else 0,
         }
+
+    def next_update(self, step):
+        now = datetime.now()
+        times = [self.last_update + timedelta(minutes=1)]
+        if self.start is not None:
+            duration = (self.end - self.start).total_seconds()
+            times += [
+                self.start,
+                self.start + timedelta(seconds=90),  # green off
+                self.end - timedelta(seconds=duration * 0.02),  # red on
+                self.end,
+            ]
+            if self.start <= now < self.end:
+                times.append(now + timedelta(seconds=step * duration / 100.0))
+        future = [t for t in times if t > now]
+        return min(future).timestamp() if future else None
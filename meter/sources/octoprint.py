@@ -1,8 +1,97 @@
 import json
-from urllib.request import Request, urlopen
+import time
+import logging
+import threading
 
+try:
+    import websocket
+    has_websocket = True
+except ImportError:
+    has_websocket = False
+
+from meter import config
+from meter.httpclient import get_json, post_json
 from meter.sources.base import BaseSource
 
+logger = logging.getLogger(__name__)
+
+
+class OctoPrintPush:
+    """Latest job state from OctoPrint's push API
+
+    A background thread logs in with the API key, keeps one websocket
+    open to /sockjs/websocket and stores the state from each `current`
+    message; reading it never blocks. The connection is re-established
+    with a backoff if it drops or goes quiet.
+
+    """
+    def __init__(self, hostname, api_key, throttle=1, timeout=30.0):
+        if not has_websocket:
+            raise Exception("websocket-client module not installed!")
+        self.hostname = hostname
+        self.api_key = api_key
+        self.throttle = throttle
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.job = None
+        self.received = None
+        self.thread = threading.Thread(target=self.run, name='octoprint-push',
+                                       daemon=True)
+        self.thread.start()
+
+    def session(self):
+        login = post_json(f'http://{self.hostname}/api/login',
+                          {'passive': True},
+                          headers={'X-Api-Key': self.api_key})
+        return f'{login["name"]}:{login["session"]}'
+
+    def listen(self):
+        ws = websocket.create_connection(
+            f'ws://{self.hostname}/sockjs/websocket', timeout=self.timeout
+        )
+        try:
+            ws.send(json.dumps({'auth': self.session()}))
+            # pushes come every 500ms unless throttled
+            ws.send(json.dumps({'throttle': self.throttle}))
+            logger.info(f'{self.hostname}: push connected')
+            while True:
+                message = json.loads(ws.recv())
+                current = message.get('current') or message.get('history')
+                if current:
+                    self.store(current)
+        finally:
+            ws.close()
+
+    def store(self, current):
+        job = {
+            'state': current['state']['text'],
+            'progress': current.get('progress') or {},
+            'job': current.get('job') or {},
+        }
+        with self.lock:
+            self.job = job
+            self.received = time.monotonic()
+
+    def run(self):
+        delay = 1.0
+        while True:
+            started = time.monotonic()
+            try:
+                self.listen()
+            except Exception as e:
+                logger.warning(f'{self.hostname}: push connection lost: {e}')
+            if time.monotonic() - started > 60:
+                delay = 1.0
+            time.sleep(delay)
+            delay = min(delay * 2, 60.0)
+
+    def snapshot(self):
+        """Return (job, seconds since it was pushed)"""
+        with self.lock:
+            if self.job is None:
+                return None, None
+            return self.job, time.monotonic() - self.received
+
 
 class OctoPrint(BaseSource):
     """OctoPrint current print status
@@ -13,9 +102,13 @@ class OctoPrint(BaseSource):
     The red light illuminates whenever the printer is not printing.
     The green light comes on when the printer is idle. The blue light
     illuminates when the printer is paused (no progress has been made
-    recently).
+    for --pause-after seconds).
+
+    With --push yes, job state is pushed over OctoPrint's websocket API
+    instead of polled (requires `pip install websocket-client`).
 
     """
+    USES_REPORTED = False
     OPTIONS = [
         (['--hostname'], {"required": True}),
         (['--api-key'], {"required": True}),
@@ -23,15 +116,39 @@ class OctoPrint(BaseSource):
          {"action": "store_true",
           'help': ('Compute progress by time rather than by'
                    ' the default (fraction of file transmitted)')}),
+        (['--push'], {'action': 'store', 'type': config.to_bool,
+                      'default': False,
+                      'help': 'receive job state over the push API'}),
+        (['--pause-after'], {'type': float, 'default': 20.0,
+                             'metavar': 'SECONDS',
+                             'help': 'flat progress for this long is a pause'}),
     ]
 
     def init(self):
-        self.history = [-1] * 5
-    
+        self.last_completion = None
+        self.last_change = time.monotonic()
+        self.push = None
+        if self.opts.push:
+            self.push = OctoPrintPush(
+                self.opts.hostname, self.opts.api_key,
+                throttle=max(1, int(self.min_cycle / 0.5)),
+            )
+
+    def fetch(self):
+        if self.push is None:
+            url = f'http://{self.opts.hostname}/api/job'
+            return get_json(url, headers={'X-Api-Key': self.opts.api_key})
+        job, age = self.push.snapshot()
+        if job is not None and age > self.push.timeout:
+            raise Exception(f'no push from {self.opts.hostname}'
+                            f' for {age:.0f}s')
+        return job
+
     def update(self, reported):
-        url = f'http://{self.opts.hostname}/api/job'
-        req = Request(url, headers={'X-Api-Key': self.opts.api_key})
-        job = json.load(urlopen(req))
+        job = self.fetch()
+        if job is None:
+            # push connection not established yet
+            return {}
         if self.opts.by_time:
             print_time = job['progress'].get('printTime')
             print_time_left = job['progress'].get('printTimeLeft')
@@ -51,9 +168,11 @@ class OctoPrint(BaseSource):
             'green': 0,
             'blue': 0,
         }
-        self.history.append(completion)
-        self.history.pop(0)
-        if all(i == self.history[0] for i in self.history[1:]):
+        now = time.monotonic()
+        if completion != self.last_completion:
+            self.last_completion = completion
+            self.last_change = now
+        elif now - self.last_change >= self.opts.pause_after:
             # job state is flat, it's probably paused from filament sensor
             state['blue'] = 25
         if job['state'] == 'Operational':
@@ -7,6 +7,7 @@ from meter.sources.base import BaseSource
 class Pomodoro(BaseSource):
     """Pomodoro timer
     """
+    USES_REPORTED = False
     OPTIONS = [
         (['--work-time'], {'type': int, 'default': 25, 'metavar': 'MINUTES',
                            'help': 'work period is MINUTES long'}),
@@ -20,12 +21,13 @@ class Pomodoro(BaseSource):
         self.phase = 'work'
         self.phase_start = time.time()
     
-    def update(self, reported):
+    def phase_duration(self):
         if self.phase == 'work':
-            phase_dur = self.opts.work_time * 60
-        else:
-            phase_dur = self.opts.break_time * 60
-            
+            return self.opts.work_time * 60
+        return self.opts.break_time * 60
+
+    def update(self, reported):
+        phase_dur = self.phase_duration()
         phase_end = self.phase_start + phase_dur
 
         if time.time() > phase_end:
@@ -42,10 +44,16 @@ class Pomodoro(BaseSource):
             'green': 50 if self.phase == 'break' else 0
         }
 
+    def next_update(self, step):
+        phase_dur = self.phase_duration()
+        return min(self.phase_start + phase_dur,
+                   time.time() + step * phase_dur / 100.0)
+
 
 class CountdownTimer(BaseSource):
     """Countdown timer
     """
+    USES_REPORTED = False
     OPTIONS = [
         (['end_time'], {'type': str}),
         (['--duration'], {'action': 'store_true', 'config_save': False,
@@ -74,3 +82,14 @@ class CountdownTimer(BaseSource):
             'meter': meter_val,
             'red': 100 - (meter_val * 10) if meter_val <= 10 else 0
         }
+
+    def next_update(self, step):
+        remaining = (self.end_time - datetime.now()).total_seconds()
+        if remaining <= 0:
+            return None
+        step_time = step * self.expected_duration / 100.0
+        red_in = remaining - self.expected_duration * 0.1
+        if red_in > 0:
+            return time.time() + min(step_time, red_in)
+        # red moves ten times as fast as the meter in the last 10%
+        return time.time() + min(step_time / 10.0, remaining)
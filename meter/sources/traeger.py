@@ -1,3 +1,6 @@
+import time
+import threading
+
 try:
     import traeger
     has_traeger = True
@@ -5,11 +8,20 @@ except ImportError:
     has_traeger = False
 
 from meter.sources.base import BaseSource
-    
+
 
 class Traeger(BaseSource):
     """Temperature probe data from Traeger WiFire
+
+    Grill status is consumed from the subscription on a background
+    thread, so a cycle only reads the latest status. The thread signs
+    in again, backing off up to five minutes, whenever the subscription
+    ends or fails. If no status arrives for --stale-after seconds, the
+    cycle fails and a new consumer replaces the (possibly hung) one;
+    replacements back off up to an hour while the grill stays quiet.
+
     """
+    USES_REPORTED = False
     OPTIONS = [
         (['--username'], {"required": True,
                           'help': 'Traeger account username'}),
@@ -20,22 +32,76 @@ class Traeger(BaseSource):
         (['--target-temp'], {"default": "PROBE_SET", 'metavar': 'T',
                              'help': ('full-scale on meter is T degrees, or if'
                                       ' "PROBE_SET", the probe set point')}),
+        (['--stale-after'], {'type': float, 'default': 120.0,
+                             'metavar': 'SECONDS',
+                             'help': 'resubscribe after this long without'
+                                     ' a status'}),
     ]
 
     def init(self):
         if not has_traeger:
             raise Exception("traeger module not installed!")
 
-        self.log(f"Signing in as {self.opts.username}...")
-        self.client = traeger.traeger(self.opts.username, self.opts.password)
+        self.lock = threading.Lock()
+        self.status = None
+        self.received = time.monotonic()
+        self.generation = 0
+        self.restart_delay = self.opts.stale_after
+        self.restart_at = 0.0
+        self.subscribe()
 
-        self.log("Subscribing to grill status updates...")
-        self.updates = self.client.grill_status_subscription()
+    def subscribe(self):
+        # a consumer blocked in next() can't be interrupted, so start a
+        # new one and have the old one exit once it gets control back
+        with self.lock:
+            self.generation += 1
+            generation = self.generation
+        threading.Thread(target=self.consume, args=(generation,),
+                         name=f'traeger-{generation}', daemon=True).start()
+
+    def resubscribe(self):
+        # each replacement may leave a hung session behind, so space
+        # them out while the grill stays quiet
+        now = time.monotonic()
+        if now < self.restart_at:
+            return
+        self.restart_at = now + self.restart_delay
+        self.restart_delay = min(self.restart_delay * 2, 3600.0)
+        self.subscribe()
+
+    def consume(self, generation):
+        delay = 1.0
+        while generation == self.generation:
+            try:
+                self.log(f"Signing in as {self.opts.username}...")
+                client = traeger.traeger(self.opts.username,
+                                         self.opts.password)
+                self.log("Subscribing to grill status updates...")
+                for status in client.grill_status_subscription():
+                    with self.lock:
+                        if generation != self.generation:
+                            return
+                        self.status = status
+                        self.received = time.monotonic()
+                        self.restart_delay = self.opts.stale_after
+                    delay = 1.0
+                self.logger.warning('grill status subscription ended')
+            except Exception:
+                self.logger.exception('grill status subscription failed')
+            time.sleep(delay)
+            delay = min(delay * 2, 300.0)
 
     def update(self, reported):
-        status = next(self.updates)
-        #self.log(repr(status))
-        
+        with self.lock:
+            status = self.status
+            age = time.monotonic() - self.received
+        if age > self.opts.stale_after:
+            self.resubscribe()
+            raise Exception(f'no grill status for {age:.0f}s')
+        if status is None:
+            # still signing in
+            return {}
+
         temp = status['status']['probe']
         start = float(self.opts.start_temp)
         if self.opts.target_temp == 'PROBE_SET':
@@ -44,7 +110,7 @@ class Traeger(BaseSource):
             end = float(self.opts.target_temp)
         meter = (temp - start) / (end - start) * 100.0
         meter = min(meter, 100.0)
-        
+
         self.log(f'Temp: {temp} {meter:.2f}%')
         return {
             'meter': meter,
@@ -1,40 +1,106 @@
-import json
-from urllib.request import urlopen
-from datetime import datetime, timedelta, timezone
+import time
+from bisect import bisect_right
 
 from meter.utils import c_to_f
+from meter.cache import DiskCache, cache_dir
+from meter.httpclient import get_json
 from meter.sources.base import BaseSource
 
 
 class OutsideTemp(BaseSource):
     """Ouside temperature from Open-Meteo.com
+
+    The hourly forecast is fetched every --forecast-ttl seconds and the
+    temperature is interpolated between hours, so the needle moves
+    smoothly without more API calls. Forecasts are cached on disk per
+    --api-url and location, and shared across restarts and processes.
+
     """
+    USES_REPORTED = False
     OPTIONS = [
         (['--coords'], {"required": True,
                         'help': 'Current location as "latitude,longitude"'}),
+        (['--api-url'], {'default': 'https://api.open-meteo.com',
+                         'metavar': 'URL'}),
+        (['--forecast-ttl'], {'type': float, 'default': 3 * 3600.0,
+                              'metavar': 'SECONDS',
+                              'help': 'refetch the forecast this often'}),
+        (['--cache-dir'], {'default': cache_dir('open-meteo'),
+                           'metavar': 'DIR'}),
     ]
 
     def init(self):
-        self.last_update = datetime.min
-    
-    def update(self, reported):
-        if datetime.now() > self.last_update + timedelta(hours=1):
-            lat, lon = self.opts.coords.split(',')
-            url = (f'https://api.open-meteo.com/v1/forecast?'
-                   f'latitude={lat}&longitude={lon}&current_weather=true')
-            response = json.load(urlopen(url))
-            
-            # convert the timestamp in the response to our current
-            # timezone as a naive datetime object
-            self.last_update = datetime.strptime(
-                response['current_weather']['time'],
-                '%Y-%m-%dT%H:%M'
-            ).replace(tzinfo=timezone.utc).astimezone().replace(tzinfo=None)
-            
-            self.log(response)
-            return {
-                'meter': c_to_f(response['current_weather']['temperature'])
+        lat, lon = (float(v) for v in self.opts.coords.split(','))
+        # ~1km, well below the model grid
+        self.location = f'{lat:.2f},{lon:.2f}'
+        # a stand-in server's forecast must not be served for the real one
+        self.key = f'{self.opts.api_url} {self.location}'
+        self.url = (f'{self.opts.api_url}/v1/forecast?latitude={lat:.2f}'
+                    f'&longitude={lon:.2f}&hourly=temperature_2m'
+                    f'&timeformat=unixtime&past_days=1&forecast_days=2')
+        self.cache = DiskCache(self.opts.cache_dir, ttl=self.opts.forecast_ttl)
+        self.times = []
+        self.temps = []
+        self.expires = 0.0
+
+    def covers(self, t):
+        return bool(self.times) and self.times[0] <= t <= self.times[-1]
+
+    def load(self):
+        forecast = self.cache.get(self.key)
+        if forecast is None:
+            response = get_json(self.url)
+            hourly = response['hourly']
+            forecast = {
+                'fetched': time.time(),
+                'time': hourly['time'],
+                'temperature': hourly['temperature_2m'],
             }
-        
-        else:
-            return {}
+            self.cache.set(self.key, forecast)
+            self.log(f'{self.location}: fetched {len(forecast["time"])} hours')
+        # missing hours come back as null
+        pairs = [(t, v) for t, v in zip(forecast['time'],
+                                        forecast['temperature'])
+                 if v is not None]
+        self.times = [t for t, _ in pairs]
+        self.temps = [v for _, v in pairs]
+        self.expires = forecast['fetched'] + self.opts.forecast_ttl
+
+    def interpolate(self, t):
+        """Return (temperature C, slope C/s) at time t"""
+        i = bisect_right(self.times, t)
+        if i == 0:
+            return self.temps[0], 0.0
+        if i == len(self.times):
+            return self.temps[-1], 0.0
+        t0, t1 = self.times[i - 1], self.times[i]
+        v0, v1 = self.temps[i - 1], self.temps[i]
+        slope = (v1 - v0) / (t1 - t0)
+        return v0 + slope * (t - t0), slope
+
+    def update(self, reported):
+        now = time.time()
+        if now >= self.expires or not self.covers(now):
+            try:
+                self.load()
+            except Exception:
+                if not self.covers(now):
+                    raise
+                self.expires = now + 300.0
+                self.logger.warning(f'{self.location}: forecast refresh failed,'
+                                    f' using the cached one', exc_info=True)
+        temp, _ = self.interpolate(now)
+        return {'meter': c_to_f(temp)}
+
+    def next_update(self, step):
+        if not self.times:
+            return None
+        now = time.time()
+        _, slope = self.interpolate(now)
+        # the slope changes on the hour
+        i = bisect_right(self.times, now)
+        boundary = self.times[i] if i < len(self.times) else now + 3600
+        if slope:
+            # meter is in F, slope in C per second
+            return min(now + step / abs(slope * 1.8), boundary)
+        return boundary
@@ -0,0 +1,169 @@
+"""Process-wide timings and counters for the meter loop
+
+Each stage of a cycle (shadow sync, source update, shadow write,
+credential refresh) is timed into a fixed-bucket histogram, so memory
+does not grow however long the meter runs. Counters track shadow
+writes made and skipped, and errors per stage.
+
+    meter OctoPrint --metrics-port 9101 --stats
+
+serves the values in the Prometheus text format on
+http://127.0.0.1:9101/metrics and prints a summary on exit.
+"""
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# seconds; anything slower lands in +Inf
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    """Cumulative-bucket histogram with a fixed number of buckets"""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th quantile"""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+
+def labels(**kwargs):
+    items = [f'{k}="{v}"' for k, v in kwargs.items() if v is not None]
+    return '{' + ','.join(items) + '}' if items else ''
+
+
+class Stats:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # (stage, thing) -> Histogram
+        self.timings = {}
+        # (name, stage, thing) -> int
+        self.counters = {}
+
+    def observe(self, stage, seconds, thing=None):
+        with self.lock:
+            key = (stage, thing)
+            if key not in self.timings:
+                self.timings[key] = Histogram(self.buckets)
+            self.timings[key].observe(seconds)
+
+    def incr(self, name, stage=None, thing=None, n=1):
+        key = (name, stage, thing)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    @contextmanager
+    def timer(self, stage, thing=None):
+        """Time the block into stage, counting it as an error if it raises"""
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.incr('errors', stage, thing)
+            raise
+        finally:
+            self.observe(stage, time.perf_counter() - started, thing)
+
+    def render(self):
+        """Return all values in the Prometheus text exposition format"""
+        with self.lock:
+            timings = sorted(self.timings.items(), key=str)
+            counters = sorted(self.counters.items(), key=str)
+        lines = ['# TYPE meter_stage_seconds histogram']
+        for (stage, thing), h in timings:
+            cumulative = 0
+            for bound, n in zip(h.buckets + ('+Inf',), h.counts):
+                cumulative += n
+                le = labels(stage=stage, thing=thing, le=bound)
+                lines.append(f'meter_stage_seconds_bucket{le} {cumulative}')
+            le = labels(stage=stage, thing=thing)
+            lines.append(f'meter_stage_seconds_sum{le} {h.sum}')
+            lines.append(f'meter_stage_seconds_count{le} {h.count}')
+        names = []
+        for (name, stage, thing), value in counters:
+            if name not in names:
+                names.append(name)
+                lines.append(f'# TYPE meter_{name}_total counter')
+            lines.append(f'meter_{name}_total{labels(stage=stage, thing=thing)}'
+                         f' {value}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """Return a human readable table of timings and counters"""
+        with self.lock:
+            timings = sorted(self.timings.items(), key=str)
+            counters = sorted(self.counters.items(), key=str)
+        lines = [f'{"stage":30}{"count":>8}{"mean ms":>10}{"p50 ms":>10}'
+                 f'{"p99 ms":>10}{"max ms":>10}']
+        for (stage, thing), h in timings:
+            name = f'{thing}/{stage}' if thing else stage
+            mean = h.sum / h.count if h.count else 0.0
+            lines.append(f'{name:30}{h.count:8}{mean * 1000:10.1f}'
+                         f'{h.quantile(0.5) * 1000:10.1f}'
+                         f'{h.quantile(0.99) * 1000:10.1f}'
+                         f'{h.max * 1000:10.1f}')
+        for (name, stage, thing), value in counters:
+            name = '/'.join(p for p in (thing, stage, name) if p)
+            lines.append(f'{name:30}{value:8}')
+        return '\n'.join(lines)
+
+
+STATS = Stats()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.stats.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class MetricsServer(ThreadingHTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', 9101), stats=None):
+        self.stats = stats or STATS
+        super().__init__(address, MetricsHandler)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever,
+                                  name='meter-metrics', daemon=True)
+        thread.start()
+        return thread
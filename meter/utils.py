@@ -1,3 +1,34 @@
 
 def c_to_f(c):
     return (c * 1.8) + 32
+
+
+def merge(dest, src):
+    """Merge a shadow state fragment into dest; None values delete keys"""
+    for k, v in src.items():
+        if v is None:
+            dest.pop(k, None)
+        elif isinstance(v, dict) and isinstance(dest.get(k), dict):
+            merge(dest[k], v)
+        else:
+            dest[k] = v
+
+
+CHANNELS = ('meter', 'red', 'green', 'blue')
+
+
+def parse_channels(s):
+    """Parse "0.5" or "meter=0.5,red=2" into a per-channel dict"""
+    if '=' not in s:
+        return {k: float(s) for k in CHANNELS}
+    values = {k: 0.0 for k in CHANNELS}
+    for item in s.split(','):
+        k, v = item.split('=')
+        values[k.strip()] = float(v)
+    return values
+
+
+def quantize(value, resolution):
+    """Round a 0-100 value to the nearest of `resolution` PWM steps"""
+    step = 100.0 / resolution
+    return round(round(value / step) * step, 6)